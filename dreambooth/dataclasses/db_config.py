@@ -29,14 +29,23 @@ class DreamboothConfig(BaseModel):
     adaptation_d0: float = 1e-8
     adaptation_eps: float = 1e-8
     attention: str = "xformers"
+    cache_decoded_images: bool = False
     cache_latents: bool = True
+    cache_text_embeddings: bool = True
+    cache_workers: int = 4
+    class_cache_size: float = 10.0
     clip_skip: int = 1
     concepts_list: List[Dict] = []
     concepts_path: str = ""
     custom_model_name: str = ""
     noise_scheduler: str = "DDPM"
+    dataloader_prefetch: int = 2
+    dataloader_workers: int = 0
     deterministic: bool = False
+    device_prefetch: int = 2
+    ema_offload: str = "none"
     ema_predict: bool = False
+    ema_update_every: int = 1
     epoch: int = 0
     epoch_pause_frequency: int = 0
     epoch_pause_time: int = 0
@@ -51,6 +60,8 @@ class DreamboothConfig(BaseModel):
     hflip: bool = False
     infer_ema: bool = False
     initial_revision: int = 0
+    latent_cache_size: float = 10.0
+    latent_crop_margin: int = 0
     learning_rate: float = 5e-6
     learning_rate_min: float = 1e-6
     lifetime_revision: int = 0
@@ -68,6 +79,8 @@ class DreamboothConfig(BaseModel):
     lr_scheduler: str = "constant_with_warmup"
     lr_warmup_steps: int = 0
     max_token_length: int = 75
+    metrics_flush_seconds: float = 5.0
+    metrics_flush_steps: int = 10
     mixed_precision: str = "fp16"
     model_name: str = ""
     model_dir: str = ""
@@ -76,6 +89,7 @@ class DreamboothConfig(BaseModel):
     offset_noise: float = 0
     optimizer: str = "8bit AdamW"
     pad_tokens: bool = True
+    png_compress_level: int = 6
     pretrained_model_name_or_path: str = ""
     pretrained_vae_name_or_path: str = ""
     prior_loss_scale: bool = False
@@ -118,6 +132,7 @@ class DreamboothConfig(BaseModel):
     use_lora_extended: bool = False
     use_subdir: bool = False
     v2: bool = False
+    vae_batch_size: int = 4
 
     def __init__(
             self,
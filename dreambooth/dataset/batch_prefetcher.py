@@ -0,0 +1,154 @@
+import threading
+import time
+from contextlib import nullcontext
+from queue import Queue, Full
+
+import torch
+from accelerate.utils import synchronize_rng_states
+from torch.utils.data import DataLoader
+
+
+class BatchPrefetcher:
+    """
+    Wraps a DataLoader and moves batches to the training device ahead of the step that uses them.
+
+    A background thread pulls the next `depth` batches from the loader, pins them and starts non-blocking
+    copies to the device on a side CUDA stream, all while the current step computes. With depth 0 batches
+    are loaded and copied on the training thread when they're needed. wait_time adds up how long training
+    sat waiting on data.
+
+    An accelerate DataLoaderShard marks the end of the data in the shared GradientState as soon as it runs out,
+    which accumulate() reads to sync gradients. Running out on the background thread would flag the batches
+    still queued, so the thread reads the shard as a plain DataLoader and the end is flagged on the training
+    thread, when the last batch is handed out.
+    """
+
+    _end = object()
+
+    def __init__(self, loader, device, depth: int = 2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(0, depth)
+        self.use_cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda and self.depth else None
+        # Total seconds spent waiting on data, and the wait for the most recent batch
+        self.wait_time = 0.0
+        self.last_wait = 0.0
+        # Seconds the loader took to produce the most recent batch, loading and collating included
+        self.last_load = 0.0
+        self.count = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch: dict) -> dict:
+        out = {}
+        for key, value in batch.items():
+            if isinstance(value, torch.Tensor):
+                if self.use_cuda and not value.is_pinned():
+                    value = value.pin_memory()
+                value = value.to(self.device, non_blocking=True)
+            out[key] = value
+        return out
+
+    def _waited(self, start: float):
+        self.last_wait = time.perf_counter() - start
+        self.wait_time += self.last_wait
+        self.count += 1
+
+    def __iter__(self):
+        if not self.depth:
+            iterator = iter(self.loader)
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+                self.last_load = time.perf_counter() - start
+                batch = self.to_device(batch)
+                self._waited(start)
+                yield batch
+
+        gradient_state = getattr(self.loader, "gradient_state", None)
+        if gradient_state is not None:
+            if self.loader.rng_types is not None:
+                synchronize_rng_states(self.loader.rng_types, self.loader.synchronized_generator)
+            gradient_state._add_dataloader(self.loader)
+            # Same batches as iterating the shard, without it touching the gradient state
+            batches = DataLoader.__iter__(self.loader)
+        else:
+            batches = iter(self.loader)
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+                    start = time.perf_counter()
+                    loaded = next(batches, self._end)
+                    while loaded is not self._end:
+                        load_time = time.perf_counter() - start
+                        loaded = self.to_device(loaded)
+                        event = None
+                        if self.stream is not None:
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                        # Look one batch ahead, so the last one can be marked as such
+                        start = time.perf_counter()
+                        upcoming = next(batches, self._end)
+                        if not put((loaded, event, load_time, upcoming is self._end)):
+                            return
+                        loaded = upcoming
+            except Exception as e:
+                put((e, None, 0.0, True))
+                return
+            put(self._end)
+
+        thread = threading.Thread(target=produce, name="db_prefetch", daemon=True)
+        thread.start()
+        removed = gradient_state is None
+        try:
+            while True:
+                start = time.perf_counter()
+                item = queue.get()
+                if item is self._end:
+                    return
+                batch, event, self.last_load, last = item
+                if isinstance(batch, Exception):
+                    raise batch
+                if last and not removed:
+                    # Sets end_of_dataloader, like the shard does before its last batch
+                    gradient_state._remove_dataloader(self.loader)
+                    removed = True
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for value in batch.values():
+                        if isinstance(value, torch.Tensor):
+                            # The copy was made on the side stream, keep its memory until this step is done with it
+                            value.record_stream(current)
+                self._waited(start)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+            if not removed:
+                gradient_state._remove_dataloader(self.loader)
+
+    def stats(self) -> str:
+        if not self.count:
+            return "Data loading: no batches."
+        return (
+            f"Data loading: {self.count} batches | Waited on data: {self.wait_time:.1f}s "
+            f"({self.wait_time / self.count * 1000:.1f} ms/batch)"
+        )
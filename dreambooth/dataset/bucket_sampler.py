@@ -1,138 +1,97 @@
 import random
-from typing import Tuple
+from typing import Union
+
+import numpy as np
 
 from dreambooth.dataset.db_dataset import DbDataset
 
 
 class BucketSampler:
-    def __init__(self, dataset: DbDataset, batch_size, debug=False):
+    """
+    Batch sampler that draws every batch from a single bucket.
+
+    Each epoch is planned up front as an array of batches, one row per batch holding the bucket index
+    followed by the sample IDs, and yielded as (sample ID, bucket resolution) indices. The plan is built
+    from a recorded seed, and together with the position in it makes up the sampler state, so a resumed
+    run continues at the exact batch it stopped at.
+    """
+
+    def __init__(self, dataset: DbDataset, batch_size, debug=False, seed: Union[int, None] = None):
         self.dataset = dataset
         self.batch_size = batch_size
         self.resolutions = dataset.resolutions
-        self.active_resos = []
-        self.bucket_counter = BucketCounter(starting_keys=self.resolutions)
-        self.batch = []
-        self.current_bucket = 0
-        self.current_index = 0
-        self.total_samples = 0
         self.debug = debug
-        self.set_buckets()
-
-    def __iter__(self):
-        while self.total_samples < len(self.dataset):
-            batch = self.fill_batch()
-            if len(batch) == 0:
-                raise StopIteration
-            yield batch
-        self.total_samples = 0
-
-    def __next__(self):
-        if len(self.batch) == 0:
-            self.batch = self.fill_batch()
-        if len(self.batch) == 0:
-            print("Well, this is bad. We have no batch data.")
-            raise StopIteration
-        return self.batch.pop()
-
-    def __len__(self):
-        return len(self.dataset.active_resolution) * self.batch_size
-
-    def set_buckets(self):
-        # Initialize list of bucket counts if not set
-        all_resos = self.resolutions
-        resos_to_use = []
-        am = self.bucket_counter.missing()
-        missing = am.copy()
-        pop_index = 0
-        # Tell the counter to check if all values are equal. If so, reset the counts to 0
-        self.bucket_counter.check_reset()
-        if len(missing):
-            while len(resos_to_use) < len(all_resos):
-                if len(missing):
-                    for res, count in am.items():
-                        resos_to_use.append(res)
-                        missing[res] -= 1
-                        if missing[res] == 0:
-                            del missing[res]
-                        am = missing.copy()
-                else:
-                    resos_to_use.append(all_resos[pop_index])
-                    pop_index += 1
-                    if pop_index >= len(all_resos):
-                        pop_index = 0
-        else:
-            resos_to_use = all_resos.copy()
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.epoch = 0
+        self.plan = self.make_plan(self.epoch)
+        # Index of the next batch in the plan to yield
+        self.position = 0
+        # Batches of the plan the training loop has actually used, which can trail position when loaders prefetch
+        self.consumed = 0
+
+    def make_plan(self, epoch: int) -> np.ndarray:
+        rng = np.random.default_rng([self.seed, epoch])
+        batches = []
+        for bucket_idx, res in enumerate(self.resolutions):
+            sample_ids = self.dataset.train_dict[res]
+            if not self.debug:
+                sample_ids = rng.permutation(sample_ids)
+            class_ids = self.dataset.class_dict.get(res)
+            if class_ids is not None and len(class_ids):
+                # Pair every instance image with a random class image from the same bucket
+                selection = class_ids[rng.integers(0, len(class_ids), len(sample_ids))]
+                sample_ids = np.stack([sample_ids, selection], axis=1).reshape(-1)
+            if not len(sample_ids):
+                continue
+            # Wrap around to the start of the bucket to fill its last batch
+            num_batches = -(-len(sample_ids) // self.batch_size)
+            sample_ids = np.resize(sample_ids, num_batches * self.batch_size).reshape(num_batches, self.batch_size)
+            batches.append(np.column_stack([np.full(num_batches, bucket_idx), sample_ids]))
+        if not len(batches):
+            return np.zeros((0, self.batch_size + 1), dtype=np.int64)
+        plan = np.concatenate(batches).astype(np.int64)
         if not self.debug:
-            random.shuffle(resos_to_use)
-        self.active_resos = resos_to_use
-        self.current_bucket = 0
-
-    def fill_batch(self):
-        current_res = self.active_resos[self.current_bucket]
-        self.dataset.shuffle_buckets()
-        batch = []
-        repeats = 0
-        while len(batch) < self.batch_size:
-            self.dataset.active_resolution = current_res
-            img_index, img_repeats = self.dataset.get_example(current_res)
-            # next_item = torch.as_tensor(next_item, device='cpu', dtype=torch.float)
-            if img_repeats != 0:
-                self.bucket_counter.count(current_res)
-                repeats += 1
-            batch.append(img_index)
-            self.total_samples += 1
-        if repeats != 0:
-            # Increment bucket if we've 'emptied' the current one
-            self.current_bucket += 1
-            # If we've run through our list of resolutions, re-create it
-            if self.current_bucket >= len(self.active_resos):
-                self.set_buckets()
-        return batch
+            plan = plan[rng.permutation(len(plan))]
+        return plan
 
-    def __getitem__(self, index):
-        if len(self.batch) == 0:
-            self.batch = self.fill_batch()
-        if len(self.batch) == 0:
-            print("Well, this is bad. We have no batch data.")
-            raise StopIteration
-        return self.batch.pop()
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.plan = self.make_plan(epoch)
+        self.position = 0
+        self.consumed = 0
 
+    def __iter__(self):
+        if self.position >= len(self.plan):
+            self.set_epoch(self.epoch + 1)
+        self.consumed = self.position
+        while self.position < len(self.plan):
+            batch = self.plan[self.position]
+            self.position += 1
+            res = self.resolutions[batch[0]]
+            yield [(sample_id, res) for sample_id in batch[1:].tolist()]
 
-class BucketCounter:
-    def __init__(self, starting_keys=None):
-        self.counts = {}
-        print("Initializing bucket counter!")
-        if starting_keys is not None:
-            for key in starting_keys:
-                self.counts[key] = 0
-
-    def count(self, key: Tuple[int, int]):
-        if key in self.counts:
-            self.counts[key] += 1
-        else:
-            self.counts[key] = 1
-
-    def min(self):
-        return min(self.counts.values()) if len(self.counts) else 0
-
-    def max(self):
-        return max(self.counts.values()) if len(self.counts) else 0
-
-    def get(self, key: Tuple[int, int]):
-        return self.counts[key] if key in self.counts else 0
-
-    def check_reset(self):
-        if self.max() == self.min():
-            for key in list(self.counts.keys()):
-                self.counts[key] = 0
-
-    def missing(self):
-        out = {}
-        max = self.max()
-        for key in list(self.counts.keys()):
-            if self.counts[key] < max:
-                out[key] = max - self.counts[key]
-        return out
-
-    def print(self):
-        print(f"Bucket counts: {self.counts}")
+    def __len__(self):
+        return len(self.plan)
+
+    def state_dict(self) -> dict:
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "position": self.consumed,
+            "plan": self.plan.tolist(),
+        }
+
+    def load_state_dict(self, state: dict):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        plan = np.array(state["plan"], dtype=np.int64)
+        if (
+                plan.ndim != 2
+                or plan.shape[1] != self.batch_size + 1
+                or (len(plan) and plan[:, 0].max() >= len(self.resolutions))
+                or (len(plan) and plan[:, 1:].max() >= len(self.dataset.samples))
+        ):
+            print("Saved batch plan doesn't match the dataset, rebuilding it.")
+            plan = self.make_plan(self.epoch)
+        self.plan = plan
+        self.position = self.consumed = min(state["position"], len(self.plan))
@@ -1,5 +1,7 @@
 import os
 import random
+from collections import Counter
+from typing import Dict, List, Set
 
 from torch.utils.data import Dataset
 
@@ -7,9 +9,10 @@ from dreambooth import shared
 from dreambooth.dataclasses.db_concept import Concept
 from dreambooth.dataclasses.prompt_data import PromptData
 from dreambooth.shared import status
+from dreambooth.utils.class_image_cache import class_seed
 from dreambooth.utils.image_utils import FilenameTextGetter, \
     make_bucket_resolutions, \
-    sort_prompts, get_images
+    sort_prompts, get_images, seed_from_name
 from helpers.mytqdm import mytqdm
 
 
@@ -24,6 +27,8 @@ class ClassDataset(Dataset):
         # Data for new prompts to generate
         self.new_prompts = {}
         self.required_prompts = 0
+        # Every new prompt, grouped by (resolution, steps, scale) so they can be generated in full batches
+        self.generation_plan: List[PromptData] = []
 
         # Thingy to build prompts
         text_getter = FilenameTextGetter(shuffle)
@@ -32,6 +37,8 @@ class ClassDataset(Dataset):
         bucket_resos = make_bucket_resolutions(max_width)
         class_images = {}
         instance_images = {}
+        # Seeds of the class images in each class folder, read from their names
+        used_seeds: Dict[str, Set[int]] = {}
         total_images = 0
         for concept_idx, concept in enumerate(concepts):
             if not concept.is_valid:
@@ -45,6 +52,11 @@ class ClassDataset(Dataset):
             os.makedirs(class_dir, exist_ok=True)
             instance_images[concept_idx] = get_images(instance_dir)
             class_images[concept_idx] = get_images(class_dir)
+            seeds = used_seeds.setdefault(os.path.abspath(class_dir), set())
+            for img in class_images[concept_idx]:
+                seed = seed_from_name(img)
+                if seed is not None:
+                    seeds.add(seed)
             total_images += len(instance_images[concept_idx])
             total_images += len(class_images[concept_idx])
 
@@ -89,12 +101,21 @@ class ClassDataset(Dataset):
 
                 # Otherwise, generate and append new class images
                 else:
-                    existing_prompts = [img.prompt for img in existing_prompt_datas]
-                    required_prompts = [img.prompt for img in required_prompt_datas]
-
-                    for prompt in required_prompts:
-                        num_to_gen = concept.num_class_images_per * required_prompts.count(prompt) - existing_prompts.count(prompt)
-                        for _ in range(num_to_gen):
+                    existing_counts = Counter(img.prompt for img in existing_prompt_datas)
+                    required_counts = Counter(img.prompt for img in required_prompt_datas)
+
+                    seeds = used_seeds[os.path.abspath(class_dir)]
+                    for prompt, required_count in required_counts.items():
+                        missing = concept.num_class_images_per * required_count - existing_counts[prompt]
+                        # Each number has its own fixed seed, take the first ones no image in the folder was made with
+                        index = 0
+                        while missing > 0:
+                            seed = class_seed(class_dir, prompt, concept.class_negative_prompt, index)
+                            index += 1
+                            if seed in seeds:
+                                continue
+                            seeds.add(seed)
+                            missing -= 1
                             pd = PromptData(
                                 prompt=prompt,
                                 negative_prompt=concept.class_negative_prompt,
@@ -104,8 +125,8 @@ class ClassDataset(Dataset):
                                 scale=concept.class_guidance_scale,
                                 out_dir=class_dir,
                                 concept_index=concept_idx,
+                                seed=seed,
                                 resolution=res)
-                            existing_prompts.append(prompt)
                             new_prompts_datas.append(pd)
 
                 # Extend class prompts by the proper amount
@@ -118,6 +139,13 @@ class ClassDataset(Dataset):
                     else:
                         self.new_prompts[res] = new_prompts_datas
 
+        groups = {}
+        for prompt_datas in self.new_prompts.values():
+            for pd in prompt_datas:
+                groups.setdefault((pd.resolution, pd.steps, pd.scale), []).append(pd)
+        for group in groups.values():
+            self.generation_plan.extend(group)
+
         pbar.reset(0)
         if self.required_prompts > 0:
             print(f"We need a total of {self.required_prompts} class images.")
@@ -126,11 +154,36 @@ class ClassDataset(Dataset):
         return self.required_prompts
 
     def __getitem__(self, index) -> PromptData:
-        res_index = 0
-        for res, prompt_datas in self.new_prompts.items():
-            for p in range(len(prompt_datas)):
-                if res_index == index:
-                    return prompt_datas[p]
-                res_index += 1
+        if 0 <= index < len(self.generation_plan):
+            return self.generation_plan[index]
         print(f"Invalid index: {index}/{self.required_prompts}")
         return None
+
+    def remove_prompts(self, done: List[PromptData]):
+        """
+        Drop prompts that no longer need to be generated from the plan.
+        """
+        done = set(id(pd) for pd in done)
+        self.generation_plan = [pd for pd in self.generation_plan if id(pd) not in done]
+        self.required_prompts = len(self.generation_plan)
+
+    def generation_batches(self, batch_size: int) -> List[List[PromptData]]:
+        """
+        Split the generation plan into batches that share a resolution, step count and guidance scale.
+        Only the last batch of each group can be short.
+        """
+        batch_size = max(1, batch_size)
+        batches = []
+        start = 0
+        while start < len(self.generation_plan):
+            first = self.generation_plan[start]
+            key = (first.resolution, first.steps, first.scale)
+            end = start
+            while end < len(self.generation_plan) and end - start < batch_size:
+                pd = self.generation_plan[end]
+                if (pd.resolution, pd.steps, pd.scale) != key:
+                    break
+                end += 1
+            batches.append(self.generation_plan[start:end])
+            start = end
+        return batches
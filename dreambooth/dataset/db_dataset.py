@@ -1,20 +1,27 @@
-import copy
 import os.path
 import random
 import traceback
+import zlib
 from typing import List, Tuple, Union
 
-import safetensors.torch
+import numpy as np
 import torch.utils.data
 from torchvision.transforms import transforms
 from transformers import CLIPTokenizer
 
 from dreambooth import shared
 from dreambooth.dataclasses.prompt_data import PromptData
+from dreambooth.dataset.image_pipeline import ImagePipeline
+from dreambooth.dataset.latent_cache import LatentCache, ContentHasher, latent_key, latent_cache_dir, \
+    image_cache_dir, shard_name
+from dreambooth.dataset.sample_table import SampleTable
+from dreambooth.dataset.token_cache import TokenCache, batch_tokenize, token_cache_file
+from dreambooth.memory import should_reduce_batch_size
 from dreambooth.shared import status
 from dreambooth.utils.image_utils import make_bucket_resolutions, \
     closest_resolution, shuffle_tags, open_and_trim
 from dreambooth.utils.text_utils import build_strict_tokens
+from dreambooth.utils.utils import cleanup
 from helpers.mytqdm import mytqdm
 
 
@@ -36,35 +43,35 @@ class DbDataset(torch.utils.data.Dataset):
             strict_tokens: bool,
             not_pad_tokens: bool,
             debug_dataset: bool,
-            model_dir: str
+            cache_workers: int = 4,
+            vae_batch_size: int = 4,
+            latent_crop_margin: int = 0,
+            cache_decoded_images: bool = False,
+            latent_cache_size: float = 10.0
     ) -> None:
         super().__init__()
-        self.batch_indices = []
-        self.batch_samples = []
-        self.cache_dir = os.path.join(model_dir, "cache")
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
         print("Init dataset!")
-        # A dictionary of string/latent pairs matching image paths
-        self.latents_cache = {}
-        # A dictionary of string/input_ids(s) pairs matching image paths
+        # Sharded on-disk store of latents, shared between models using the same VAE
+        self.latent_cache = None
+        # A dictionary of image paths and their content-addressed latent cache keys, as (unflipped, flipped or None)
+        self.latent_keys = {}
+        # Store of decoded, bucket-cropped pixels, used instead of decoding originals when latents aren't cached
+        self.image_cache = None
+        self.cache_decoded_images = cache_decoded_images
+        # A dictionary of image paths and their image cache keys
+        self.image_keys = {}
+        # Bytes each of the two stores may keep, least recently used entries of other models are removed above it
+        self.cache_max_bytes = int(latent_cache_size * 1024 ** 3)
+        # A dictionary of caption IDs and their input_ids
         self.caption_cache = {}
-        # A dictionary of (int, int) / List[(string, string)] of resolutions and the corresponding image paths/captions
+        # A dictionary of (int, int, int) / sample IDs of bucket resolutions and concepts, and the instance images in them
         self.train_dict = {}
-        # A dictionary of (int, int) / List[(string, string)] of resolutions and the corresponding image paths/captions
+        # A dictionary of (int, int, int) / sample IDs of bucket resolutions and concepts, and the class images in them
         self.class_dict = {}
-        # A mash-up of the class/train dicts that is perfectly fair and balanced.
-        self.sample_dict = {}
-        # This is where we just keep a list of everything for batching
-        self.sample_cache = []
-        # This is just a list of the sample names that we can use to find where in the cache an image is
-        self.sample_indices = []
+        # Every sample, indexed by sample ID
+        self.samples = SampleTable()
         # All of the available bucket resolutions
         self.resolutions = []
-        # Currently active resolution
-        self.active_resolution = (0, 0)
-        # The currently active image index while iterating
-        self.image_index = 0
         # Total len of the dataloader
         self._length = 0
         self.batch_size = batch_size
@@ -83,6 +90,22 @@ class DbDataset(torch.utils.data.Dataset):
         self.tokens = tokens
         self.vae = None
         self.cache_latents = False
+        # Decodes and crops images on a worker pool ahead of the VAE
+        self.image_pipeline = ImagePipeline(cache_workers)
+        # Images per VAE encode while caching, halved automatically on OOM
+        self.vae_batch_size = max(1, vae_batch_size)
+        # The first batched encode is compared with a single-image encode, see check_batched_latents
+        self.vae_batch_checked = False
+        self.hflip = hflip
+        # Extra pixels cached around each latent so it can be randomly cropped, one latent pixel covers 8 pixels
+        self.latent_crop_margin = max(0, int(latent_crop_margin)) // 8 * 8
+        # Cached latents are flipped explicitly, so caching never applies random transforms
+        self.cache_transforms = transforms.Compose(
+            [
+                transforms.ToTensor(),
+                transforms.Normalize([0.5], [0.5]),
+            ]
+        )
         flip_p = 0.5 if hflip else 0.0
         if hflip:
             self.image_transforms = transforms.Compose(
@@ -102,33 +125,121 @@ class DbDataset(torch.utils.data.Dataset):
             )
 
     def load_image(self, image_path, caption, res):
+        cache_key = None
         if self.debug_dataset:
             image = os.path.splitext(image_path)
             input_ids = caption
         else:
             if self.cache_latents:
-                image = self.latents_cache[image_path]
+                image, cache_key = self.load_latent(image_path)
+            elif image_path in self.image_keys:
+                image = self.load_cached_image(image_path)
             else:
-                img = open_and_trim(image_path, res, False)
-                image = self.image_transforms(img)
+                image = self.prepare_image(image_path, res)
             if self.shuffle_tags:
-                caption, input_ids = self.cache_caption(image_path, caption)
+                caption, input_ids = self.cache_caption(caption)
             else:
-                input_ids = self.caption_cache[image_path]
-        return image, input_ids
+                input_ids = self.caption_cache[self.samples.caption_id(caption)]
+        return image, input_ids, cache_key
 
-    def cache_latent(self, image_path, res):
-        if self.vae is not None:
-            image = open_and_trim(image_path, res, False)
-            img_tensor = self.image_transforms(image)
-            img_tensor = img_tensor.unsqueeze(0).to(device=self.vae.device, dtype=self.vae.dtype)
-            latents = self.vae.encode(img_tensor).latent_dist.sample().squeeze(0).to("cpu")
-            self.latents_cache[image_path] = latents
+    def load_latent(self, image_path):
+        """
+        Pick a cached variant of the image: flipped or not, and a random crop of the oversized latent.
+        Returns the latent and its cache key, or None for the key when the latent was cropped.
+        """
+        key, flipped_key = self.latent_keys[image_path]
+        if flipped_key is not None and random.random() < 0.5:
+            key = flipped_key
+        latent = self.latent_cache.get(key)
+        if self.latent_crop_margin:
+            margin = self.latent_crop_margin // 8
+            top = random.randint(0, margin)
+            left = random.randint(0, margin)
+            height = latent.shape[-2] - margin
+            width = latent.shape[-1] - margin
+            return latent[:, top:top + height, left:left + width], None
+        return latent, key
 
-    def cache_caption(self, image_path, caption):
+    def load_cached_image(self, image_path):
+        """
+        Decoded pixels from the image cache, randomly flipped and normalized the same way image_transforms does.
+        """
+        pixels = self.image_cache.get(self.image_keys[image_path])
+        image = pixels.permute(2, 0, 1).float().div(127.5).sub(1.0)
+        if self.hflip and random.random() < 0.5:
+            image = image.flip(-1)
+        return image
+
+    def prepare_image(self, image_path, res):
+        image = open_and_trim(image_path, res, False)
+        return self.image_transforms(image)
+
+    def prepare_cache_image(self, image_path, res):
+        if self.latent_crop_margin:
+            res = (res[0] + self.latent_crop_margin, res[1] + self.latent_crop_margin)
+        image = open_and_trim(image_path, res, False)
+        return self.cache_transforms(image)
+
+    @torch.no_grad()
+    def encode_latents(self, img_tensors: List[torch.Tensor], keys: List[str]) -> torch.Tensor:
+        img_tensors = torch.stack(img_tensors).to(device=self.vae.device, dtype=self.vae.dtype)
+        latent_dist = self.vae.encode(img_tensors).latent_dist
+        # Same as latent_dist.sample(), but every image draws its noise from a generator seeded by its cache key,
+        # so the noise doesn't depend on how the images were batched. The VAE's mean and std can still differ
+        # slightly between batch sizes, check_batched_latents falls back to single images when they do.
+        noise = torch.stack([
+            torch.randn(latent_dist.mean.shape[1:], generator=torch.Generator().manual_seed(zlib.crc32(key.encode())))
+            for key in keys
+        ]).to(device=latent_dist.mean.device, dtype=latent_dist.mean.dtype)
+        return latent_dist.mean + latent_dist.std * noise
+
+    def check_batched_latents(self, latents: torch.Tensor, img_tensors: List[torch.Tensor], keys: List[str]
+                              ) -> torch.Tensor:
+        """
+        Compare every image of the first batch with encoding it on its own. Batched convolutions aren't guaranteed
+        to be bit-identical, so they have to agree to within a few units of the latent dtype's precision. Otherwise
+        every image is encoded on its own from then on, and the single-image latents are returned for this batch.
+        """
+        self.vae_batch_checked = True
+        single = torch.cat([self.encode_latents([img_tensor], [key]) for img_tensor, key in zip(img_tensors, keys)])
+        eps = 4 * torch.finfo(latents.dtype).eps
+        if torch.allclose(latents.float(), single.float(), rtol=eps, atol=eps):
+            return latents
+        error = (latents.float() - single.float()).abs().max().item()
+        print(f"Batched VAE encodes differ from single images by up to {error:.4f}, encoding one image at a time.")
+        self.vae_batch_size = 1
+        return single
+
+    def cache_latents_batch(self, latent_keys: List[str], img_tensors: List[torch.Tensor]):
+        """
+        Encode a list of same-resolution images in batches of vae_batch_size, halving the batch on OOM.
+        """
+        if self.vae is None:
+            return
+        start = 0
+        while start < len(latent_keys):
+            end = min(start + self.vae_batch_size, len(latent_keys))
+            keys = latent_keys[start:end]
+            try:
+                latents = self.encode_latents(img_tensors[start:end], keys)
+            except Exception as e:
+                if not should_reduce_batch_size(e) or self.vae_batch_size == 1:
+                    raise
+                cleanup()
+                self.vae_batch_size = max(1, self.vae_batch_size // 2)
+                print(f"OOM encoding latents, reducing VAE batch size to {self.vae_batch_size}.")
+                continue
+            if not self.vae_batch_checked and len(keys) > 1:
+                latents = self.check_batched_latents(latents, img_tensors[start:end], keys)
+            for key, latent in zip(keys, latents):
+                self.latent_cache.put(key, latent)
+            start = end
+
+    def cache_caption(self, caption):
         input_ids = None
         auto_add_special_tokens = False if self.strict_tokens else True
-        if self.tokenizer is not None and (image_path not in self.caption_cache or self.debug_dataset):
+        caption_id = self.samples.caption_id(caption)
+        if self.tokenizer is not None and (caption_id not in self.caption_cache or self.debug_dataset):
             if self.shuffle_tags:
                 caption = shuffle_tags(caption)
             if self.strict_tokens:
@@ -142,9 +253,33 @@ class DbDataset(torch.utils.data.Dataset):
                                            add_special_tokens=auto_add_special_tokens,
                                            return_tensors='pt').input_ids
             if not self.shuffle_tags:
-                self.caption_cache[image_path] = input_ids
+                self.caption_cache[caption_id] = input_ids
         return caption, input_ids
 
+    def cache_captions(self, captions: List[str]):
+        """
+        Tokenize every caption in one batch, reusing token IDs persisted by earlier runs.
+        Captions are given in caption ID order.
+        """
+        if self.tokenizer is None or self.shuffle_tags or not len(captions):
+            return
+        add_special_tokens = False if self.strict_tokens else True
+        padding = True if self.not_pad_tokens else "max_length"
+        texts = {}
+        for caption_id, caption in enumerate(captions):
+            if self.strict_tokens:
+                caption = build_strict_tokens(caption, self.tokenizer.bos_token, self.tokenizer.eos_token)
+            texts[caption_id] = caption
+        token_cache = TokenCache(token_cache_file(self.tokenizer, padding, add_special_tokens))
+        missing = sorted(set(text for text in texts.values() if text not in token_cache))
+        if len(missing):
+            print(f"Tokenizing {len(missing)} captions.")
+            for text, ids in zip(missing, batch_tokenize(self.tokenizer, missing, padding, add_special_tokens)):
+                token_cache.put(text, ids)
+            token_cache.save()
+        for caption_id, text in texts.items():
+            self.caption_cache[caption_id] = torch.from_numpy(token_cache.get(text).astype(np.int64))[None]
+
     def make_buckets_with_caching(self, vae):
         self.vae = vae
         self.cache_latents = vae is not None
@@ -171,32 +306,98 @@ class DbDataset(torch.utils.data.Dataset):
         sort_images(self.class_img_data, bucket_resos, self.class_dict, True)
 
         def cache_images(images, reso, p_bar):
-            for img_path, cap, is_prior in images:
+            """
+            Cache the images of one bucket, add them to the sample table and return their sample IDs.
+            """
+            to_encode = []
+            # Variants still missing from the store, as a list of (key, flipped) per image path
+            missing = {}
+            failed = set()
+            margin = self.latent_crop_margin
+            if self.cache_latents and not self.debug_dataset:
+                for img_path, cap, is_prior in images:
+                    try:
+                        # Key on the file contents and crop, so edited images or a new bucket get re-encoded
+                        content_hash = hasher.hash(img_path)
+                        keys = (
+                            latent_key(content_hash, reso, False, margin),
+                            latent_key(content_hash, reso, True, margin) if self.hflip else None
+                        )
+                        self.latent_keys[img_path] = keys
+                        # If a variant is not already in the store, cache it
+                        variants = [(key, flipped) for flipped, key in enumerate(keys)
+                                    if key is not None and key not in self.latent_cache]
+                        if len(variants):
+                            missing[img_path] = variants
+                            to_encode.append(img_path)
+                    except Exception as e:
+                        print(f"Exception caching: {img_path}: {e}")
+                        failed.add(img_path)
+            elif self.image_cache is not None:
+                for img_path, cap, is_prior in images:
+                    try:
+                        content_hash = hasher.hash(img_path)
+                        key = latent_key(content_hash, reso)
+                        self.image_keys[img_path] = key
+                        if key not in self.image_cache:
+                            to_encode.append(img_path)
+                    except Exception as e:
+                        print(f"Exception caching: {img_path}: {e}")
+                        failed.add(img_path)
+
+            def encode_batch(paths, keys, tensors):
                 try:
-                    # If the image is not in the "precache",cache it
-                    if img_path not in latents_cache:
-                        if self.cache_latents and not self.debug_dataset:
-                            self.cache_latent(img_path, reso)
-                    # Otherwise, load it from existing cache
-                    else:
-                        self.latents_cache[img_path] = latents_cache[img_path]
-                    if not self.shuffle_tags:
-                        self.cache_caption(img_path, cap)
-                    self.sample_indices.append(img_path)
-                    self.sample_cache.append((img_path, cap, is_prior))
-                    p_bar.update()
-                except Exception as e:
+                    self.cache_latents_batch(keys, tensors)
+                except Exception as ex:
                     traceback.print_exc()
-                    print(f"Exception caching: {img_path}: {e}")
-                    if img_path in self.caption_cache:
-                        del self.caption_cache[img_path]
-                    if (img_path, cap, is_prior) in self.sample_cache:
-                        del self.sample_cache[(img_path, cap, is_prior)]
-                    if img_path in self.sample_indices:
-                        del self.sample_indices[img_path]
-                    if img_path in self.latents_cache:
-                        del self.latents_cache[img_path]
-            self.latents_cache.update(latents_cache)
+                    print(f"Exception caching: {', '.join(set(paths))}: {ex}")
+                    failed.update(paths)
+
+            # Decode/crop on the worker pool while the VAE encodes whatever is ready
+            batch_paths = []
+            batch_keys = []
+            batch_tensors = []
+            if self.image_cache is not None:
+                # Without latents, cache the cropped pixels so later epochs skip decoding and resizing
+                image_loader = lambda path: open_and_trim(path, reso, False)
+                for img_path, pixels in self.image_pipeline.run(to_encode, image_loader):
+                    p_bar.update()
+                    if isinstance(pixels, Exception):
+                        print(f"Exception caching: {img_path}: {pixels}")
+                        failed.add(img_path)
+                        del self.image_keys[img_path]
+                        continue
+                    self.image_cache.put(self.image_keys[img_path], torch.from_numpy(pixels), shard_name(reso))
+                to_encode_latents = []
+            else:
+                to_encode_latents = to_encode
+            image_loader = lambda path: self.prepare_cache_image(path, reso)
+            for img_path, img_tensor in self.image_pipeline.run(to_encode_latents, image_loader):
+                p_bar.update()
+                if isinstance(img_tensor, Exception):
+                    print(f"Exception caching: {img_path}: {img_tensor}")
+                    failed.add(img_path)
+                    continue
+                for key, flipped in missing[img_path]:
+                    batch_paths.append(img_path)
+                    batch_keys.append(key)
+                    batch_tensors.append(img_tensor.flip(-1) if flipped else img_tensor)
+                if len(batch_keys) >= self.vae_batch_size:
+                    encode_batch(batch_paths, batch_keys, batch_tensors)
+                    batch_paths = []
+                    batch_keys = []
+                    batch_tensors = []
+            if len(batch_keys):
+                encode_batch(batch_paths, batch_keys, batch_tensors)
+
+            encoded = set(to_encode)
+            sample_ids = []
+            for img_path, cap, is_prior in images:
+                if img_path not in failed:
+                    sample_ids.append(self.samples.add(img_path, cap, is_prior))
+                if img_path not in encoded:
+                    p_bar.update()
+            return np.array(sample_ids, dtype=np.int32)
 
         bucket_idx = 0
         total_len = 0
@@ -211,11 +412,13 @@ class DbDataset(torch.utils.data.Dataset):
         total_instances = 0
         total_classes = 0
         pbar = mytqdm(range(p_len), desc="Caching latents..." if self.cache_latents else "Processing images...", position=0)
-        image_cache_file = os.path.join(self.cache_dir, f"image_cache_{self.resolution}.safetensors")
-        latents_cache = {}
-        if os.path.exists(image_cache_file):
-            print("Loading cached latents...")
-            latents_cache = safetensors.torch.load_file(image_cache_file)
+        hasher = None
+        if self.cache_latents:
+            self.latent_cache = LatentCache(latent_cache_dir(vae))
+            hasher = ContentHasher(os.path.join(shared.dreambooth_cache_path, "latents", "file_hashes.json"))
+        elif self.cache_decoded_images and not self.debug_dataset:
+            self.image_cache = LatentCache(image_cache_dir())
+            hasher = ContentHasher(os.path.join(image_cache_dir(), "file_hashes.json"))
         for dict_idx, train_images in self.train_dict.items():
             if not train_images:
                 continue
@@ -224,14 +427,14 @@ class DbDataset(torch.utils.data.Dataset):
             # This should really be the index, because we want the bucket sampler to shuffle them all
             self.resolutions.append(dict_idx)
             # Cache with the actual res, because it's used to crop
-            cache_images(train_images, res, pbar)
+            self.train_dict[dict_idx] = cache_images(train_images, res, pbar)
             inst_count = len(train_images)
             class_count = 0
             if dict_idx in self.class_dict:
                 # Use dict index to find class images
                 class_images = self.class_dict[dict_idx]
                 # Use actual res here as well
-                cache_images(class_images, res, pbar)
+                self.class_dict[dict_idx] = cache_images(class_images, res, pbar)
                 class_count = len(class_images)
             total_instances += inst_count
             total_classes += class_count
@@ -247,15 +450,38 @@ class DbDataset(torch.utils.data.Dataset):
             pbar.write(
                 f"Bucket {bucket_str} {dict_idx} - Instance Images: {inst_str} | Class Images: {class_str} | Max Examples/batch: {ex_str}")
             bucket_idx += 1
-        try:
-            if set(self.latents_cache.keys()) != set(latents_cache.keys()):
-                print("Saving cache!")
-                del latents_cache
-                if os.path.exists(image_cache_file):
-                    os.remove(image_cache_file)
-                safetensors.torch.save_file(copy.deepcopy(self.latents_cache), image_cache_file)
-        except:
-            pass
+        self.samples.freeze()
+        # Drop buckets where every image failed, and class buckets that have no instance bucket to pair with
+        self.resolutions = [res for res in self.resolutions if len(self.train_dict[res])]
+        self.train_dict = {key: ids for key, ids in self.train_dict.items() if key in self.resolutions}
+        self.class_dict = {key: ids for key, ids in self.class_dict.items() if key in self.train_dict}
+        if not self.shuffle_tags:
+            try:
+                self.cache_captions(self.samples.captions)
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Exception tokenizing captions, falling back to one at a time: {e}")
+                for cap in self.samples.captions:
+                    self.cache_caption(cap)
+        if self.latent_cache is not None:
+            try:
+                hasher.save()
+                in_use = [key for keys in self.latent_keys.values() for key in keys if key is not None]
+                self.latent_cache.evict(self.cache_max_bytes, in_use)
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Exception saving latent cache: {e}")
+        if self.image_cache is not None:
+            try:
+                hasher.save()
+                self.image_cache.evict(self.cache_max_bytes, self.image_keys.values())
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Exception saving image cache: {e}")
+        if self.image_pipeline.count:
+            pbar.write(self.image_pipeline.stats())
+        # The VAE is only needed for caching, and DataLoader workers shouldn't carry a reference to it
+        self.vae = None
         bucket_str = str(bucket_idx).rjust(max_idx_chars, " ")
         inst_str = str(total_instances).rjust(len(str(ni)), " ")
         class_str = str(total_classes).rjust(len(str(nc)), " ")
@@ -265,77 +491,57 @@ class DbDataset(torch.utils.data.Dataset):
         self._length = total_len
         print(f"\nTotal images / batch: {self._length}, total examples: {total_len}")
 
-    def shuffle_buckets(self):
-        sample_dict = {}
-        batch_indices = []
-        batch_samples = []
-        keys = list(self.train_dict.keys())
-        if not self.debug_dataset:
-            random.shuffle(keys)
-        for key in keys:
-            sample_list = []
-            if not self.debug_dataset:
-                random.shuffle(self.train_dict[key])
-            for entry in self.train_dict[key]:
-                sample_list.append(entry)
-                batch_indices.append(entry[0])
-                batch_samples.append(entry)
-                if key in self.class_dict:
-                    class_entries = self.class_dict[key]
-                    selection = random.choice(class_entries)
-                    batch_indices.append(selection[0])
-                    batch_samples.append(selection)
-                    sample_list.append(selection)
-            sample_dict[key] = sample_list
-        self.sample_dict = sample_dict
-        self.batch_indices = batch_indices
-        self.batch_samples = batch_samples
-
     def __len__(self):
         return self._length
 
-    def get_example(self, res):
-        # Select the current bucket of image paths
-        bucket = self.sample_dict[res]
-
-        # Set start position from last iteration
-        img_index = self.image_index
-
-        # Reset image index (double-check)
-        if img_index >= len(bucket):
-            img_index = 0
-
-        repeats = 0
-        # Grab instance image data
-        image_path, caption, is_class_image = bucket[img_index]
-        image_index = self.sample_indices.index(image_path)
-
-        img_index += 1
-
-        # Reset image index
-        if img_index >= len(bucket):
-            img_index = 0
-            repeats += 1
-
-        self.image_index = img_index
-
-        return image_index, repeats
-
     def __getitem__(self, index):
-        image_path, caption, is_class_image = self.sample_cache[index]
+        # Indices come from the bucket sampler as (sample ID, bucket resolution), so loading keeps no state
+        # and can happen in DataLoader workers.
+        sample_id, res = index
+        image_path, caption, is_class_image = self.samples.row(sample_id)
+        cache_key = None
         if not self.debug_dataset:
-            image_data, input_ids = self.load_image(image_path, caption, self.active_resolution)
+            image_data, input_ids, cache_key = self.load_image(image_path, caption, res)
         else:
             image_data = image_path
             # print(f"Recoding: {caption}")
-            caption, cap_tokens = self.cache_caption(image_path, caption)
+            caption, cap_tokens = self.cache_caption(caption)
             rebuilt = self.tokenizer.decode(cap_tokens.tolist()[0])
             input_ids = (caption, rebuilt)
         # If we have reached the end of our bucket, increment to the next, update the count, reset image index.
         example = {
             "image": image_data,
             "input_ids": input_ids,
-            "res": self.active_resolution,
-            "is_class": is_class_image
+            "res": res,
+            "is_class": is_class_image,
+            "latent_key": cache_key
         }
         return example
+
+    def collate_fn(self, examples):
+        input_ids = [example["input_ids"] for example in examples]
+        pixel_values = [example["image"] for example in examples]
+        # Masks prior samples in the per-sample loss, and goes to the device with the rest of the batch
+        types = torch.tensor([example["is_class"] for example in examples], dtype=torch.bool)
+        latent_keys = [example["latent_key"] for example in examples]
+        if self.cache_latents and None not in latent_keys:
+            # Batches come straight out of the mapped latent shards
+            pixel_values = self.latent_cache.get_batch(latent_keys)
+        elif self.cache_latents:
+            # Randomly cropped latents are views, so they still have to be stacked
+            pixel_values = torch.stack(pixel_values)
+        else:
+            pixel_values = torch.stack(pixel_values)
+            pixel_values = pixel_values.to(
+                memory_format=torch.contiguous_format
+            ).float()
+        input_ids = torch.cat(input_ids, dim=0)
+
+        batch_data = {
+            "input_ids": input_ids,
+            # Text embedding cache keys, read here so the training step never reads the IDs back from the device
+            "caption_keys": [tuple(row) for row in input_ids.tolist()],
+            "images": pixel_values,
+            "types": types,
+        }
+        return batch_data
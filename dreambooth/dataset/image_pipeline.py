@@ -0,0 +1,84 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple, Any
+
+
+class ImagePipeline:
+    """
+    Producer/consumer pipeline for image preprocessing.
+
+    A thread pool decodes and crops images ahead of the consumer (PIL releases the GIL while decoding
+    and resizing), keeping at most queue_size results in flight. Results are yielded in input order,
+    so the consumer (usually the VAE) only waits when the workers fall behind.
+    """
+
+    def __init__(self, num_workers: int = 4, queue_size: int = 0):
+        self.num_workers = max(0, num_workers)
+        self.queue_size = queue_size if queue_size > 0 else max(1, self.num_workers) * 4
+        # Summed time the workers spent producing images
+        self.produce_time = 0.0
+        # Time the consumer spent blocked waiting on the workers
+        self.wait_time = 0.0
+        # Time the consumer spent on each result between yields
+        self.consume_time = 0.0
+        self.count = 0
+
+    @staticmethod
+    def _timed(fn: Callable, item: Any) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        try:
+            result = fn(item)
+        except Exception as e:
+            result = e
+        return result, time.perf_counter() - start
+
+    def run(self, items: Iterable, load_fn: Callable) -> Iterator[Tuple[Any, Any]]:
+        """
+        Yield (item, load_fn(item)) pairs in order. If load_fn raises, the exception is yielded
+        in place of the result, so one bad file doesn't stop the others.
+        """
+        if self.num_workers == 0:
+            for item in items:
+                result, elapsed = self._timed(load_fn, item)
+                self.produce_time += elapsed
+                yield from self._consume(item, result)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="db_image") as pool:
+            source = iter(items)
+            in_flight = deque()
+
+            def submit():
+                for item in source:
+                    in_flight.append((item, pool.submit(self._timed, load_fn, item)))
+                    return
+
+            for _ in range(self.queue_size):
+                submit()
+
+            while len(in_flight):
+                item, future = in_flight.popleft()
+                start = time.perf_counter()
+                result, elapsed = future.result()
+                self.wait_time += time.perf_counter() - start
+                self.produce_time += elapsed
+                submit()
+                yield from self._consume(item, result)
+
+    def _consume(self, item, result):
+        start = time.perf_counter()
+        yield item, result
+        self.consume_time += time.perf_counter() - start
+        self.count += 1
+
+    def stats(self) -> str:
+        if not self.count:
+            return "Image pipeline: no images processed."
+        workers = max(1, self.num_workers)
+        produce_rate = self.count / self.produce_time * workers if self.produce_time else 0
+        consume_rate = self.count / self.consume_time if self.consume_time else 0
+        return (
+            f"Image pipeline: {self.count} images | Decode: {produce_rate:.1f} img/s ({workers} workers) | "
+            f"Encode: {consume_rate:.1f} img/s | Waited on decode: {self.wait_time:.1f}s"
+        )
@@ -0,0 +1,626 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import torch
+
+from dreambooth import shared
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+_DTYPE_NAMES = {
+    torch.float32: "float32",
+    torch.float16: "float16",
+    torch.bfloat16: "bfloat16",
+    torch.uint8: "uint8",
+}
+
+_TORCH_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "uint8": torch.uint8,
+}
+
+# Numpy has no bfloat16, so those shards are stored as raw 16-bit words and re-viewed by torch.
+_NP_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.int16,
+    "uint8": np.uint8,
+}
+
+
+def shard_name(res: Tuple[int, int]) -> str:
+    return f"{res[0]}x{res[1]}"
+
+
+def latent_key(content_hash: str, res: Tuple[int, int], flipped: bool = False, margin: int = 0) -> str:
+    """
+    Cache key for one variant of an image encoded at one bucket resolution: optionally flipped, and
+    optionally oversized by margin pixels for random crops. The VAE and dtype are part of the store
+    directory, so together these cover everything that changes the resulting latents.
+    """
+    key = f"{content_hash}_{shard_name(res)}"
+    if margin:
+        key += f"_m{margin}"
+    if flipped:
+        key += "_flip"
+    return key
+
+
+@torch.no_grad()
+def vae_fingerprint(vae) -> str:
+    """
+    Hash the VAE config and weights, so every model fine-tuned from the same base VAE maps to the same store.
+    Private config keys like _name_or_path are left out, they differ for every model directory.
+    """
+    sha = hashlib.sha1()
+    config = {key: value for key, value in dict(vae.config).items() if not key.startswith("_")}
+    sha.update(json.dumps(config, sort_keys=True, default=str).encode())
+    for name, tensor in sorted(vae.state_dict().items()):
+        sha.update(name.encode())
+        # Go through fp32, since numpy can't represent bf16 tensors
+        sha.update(tensor.detach().float().cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def latent_cache_dir(vae) -> str:
+    dtype = _DTYPE_NAMES.get(vae.dtype, str(vae.dtype).replace("torch.", ""))
+    return os.path.join(shared.dreambooth_cache_path, "latents", f"{vae_fingerprint(vae)}_{dtype}")
+
+
+def image_cache_dir() -> str:
+    """
+    Store for decoded images cropped to their bucket, as uint8 (H, W, C) pixels, for training without cached latents.
+    """
+    return os.path.join(shared.dreambooth_cache_path, "images")
+
+
+class ContentHasher:
+    """
+    Hashes image file contents, remembering results by (size, mtime) so unchanged files are only read once.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}
+        self.dirty = False
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r") as f:
+                    self.hashes = {path: tuple(value) for path, value in json.load(f).items()}
+            except Exception as e:
+                print(f"Exception loading file hashes: {e}")
+        # Forget files that were deleted or moved since
+        missing = [path for path in self.hashes if not os.path.exists(path)]
+        for path in missing:
+            del self.hashes[path]
+        self.dirty = len(missing) > 0
+
+    def hash(self, path: str) -> str:
+        stat = os.stat(path)
+        known = self.hashes.get(path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self.hashes[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        self.dirty = True
+        return digest
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
+
+
+class CacheLock:
+    """
+    Advisory lock on a file, so several processes can share a cache folder. The OS drops it when the
+    process exits, even if it crashes. Windows only has exclusive locks, so shared locks are a no-op there.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def __getstate__(self):
+        # Locks belong to the process that took them, worker processes start without one
+        state = self.__dict__.copy()
+        state["file"] = None
+        return state
+
+    def acquire(self, shared: bool = False, blocking: bool = True) -> bool:
+        if self.file is None:
+            self.file = open(self.path, "a+b")
+        if os.name == "nt":
+            if shared:
+                return True
+            while True:
+                try:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                    return True
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds, keep waiting
+                    if not blocking:
+                        return False
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.file.fileno(), flags)
+        except BlockingIOError:
+            return False
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        try:
+            if os.name == "nt":
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        except OSError:
+            pass
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class LatentShard:
+    """
+    A single bucket resolution worth of latents, stored as one contiguous, append-only array on disk.
+    """
+
+    def __init__(self, name: str, path: str, shape: Tuple[int, ...], dtype: str):
+        self.name = name
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.row_bytes = int(np.prod(self.shape)) * np.dtype(_NP_DTYPES[dtype]).itemsize
+        self.count = 0
+        self._array = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Pick up rows other processes appended. Call with the cache lock held.
+        """
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        count = size // self.row_bytes
+        if size != count * self.row_bytes:
+            # Drop a partially written row left behind by an interrupted append
+            with open(self.path, "r+b") as f:
+                f.truncate(count * self.row_bytes)
+        if count != self.count:
+            self.count = count
+            self.close()
+
+    def __getstate__(self):
+        # Pickling a memmap copies its data, let worker processes map the file themselves instead
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def array(self) -> Union[np.memmap, None]:
+        if self._array is None and self.count > 0:
+            # Copy-on-write keeps the mapping lazy but gives torch a writable buffer, so no data is read up front.
+            self._array = np.memmap(self.path, dtype=_NP_DTYPES[self.dtype], mode="c",
+                                    shape=(self.count, *self.shape))
+        return self._array
+
+    def to_torch(self, data: np.ndarray) -> torch.Tensor:
+        tensor = torch.from_numpy(data)
+        if self.dtype == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+        return tensor
+
+    def row(self, index: int) -> torch.Tensor:
+        return self.to_torch(self.array()[index])
+
+    def rows(self, indices: List[int]) -> torch.Tensor:
+        array = self.array()
+        start = indices[0]
+        if indices == list(range(start, start + len(indices))):
+            # Contiguous rows are a plain view of the mapping
+            return self.to_torch(array[start:start + len(indices)])
+        return self.to_torch(np.take(array, indices, axis=0))
+
+    def append(self, latents: torch.Tensor) -> int:
+        """
+        Append a stack of latents to the end of the shard and return the row of the first one.
+        """
+        if self.dtype == "bfloat16":
+            latents = latents.view(torch.int16)
+        data = np.ascontiguousarray(latents.numpy().astype(_NP_DTYPES[self.dtype], copy=False))
+        with open(self.path, "ab") as f:
+            # Rows go where the file actually ends, other processes may have appended since count was read
+            start = f.seek(0, os.SEEK_END) // self.row_bytes
+            f.write(data.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.count = start + len(data)
+        # The mapping is rebuilt on the next read so it covers the new rows
+        self.close()
+        return start
+
+    def close(self):
+        self._array = None
+
+
+class LatentCache:
+    """
+    Sharded, memory-mapped store for cached latents.
+
+    Every bucket resolution gets its own shard file holding its latents back to back, and an append-only
+    journal maps each cache key to a (shard, row) pair. Shards are opened with mmap, so nothing is read
+    from disk until a sample is actually requested.
+
+    New latents are appended in chunks of flush_every while caching runs. Shard data is always synced
+    before the journal records that point at it, so an interrupted run keeps everything up to its last
+    flush. Removed entries are tombstoned in the journal, and compact() reclaims their rows. evict() removes
+    the least recently used entries once the store grows past a size.
+
+    Several processes can share a store: flushes and compaction hold a file lock and first read what the
+    others journaled. Every open cache holds a shared lock on the folder, and compaction only deletes
+    the old shards once no other process holds it, since they may still be mapping them.
+    """
+
+    journal_name = "index.jsonl"
+    # Last time each key was used by a dataset, written by evict()
+    used_name = "used.json"
+
+    def __init__(self, cache_dir: str, flush_every: int = 64):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.journal_file = os.path.join(self.cache_dir, self.journal_name)
+        self.used_file = os.path.join(self.cache_dir, self.used_name)
+        self.flush_every = flush_every
+        # key -> (shard name, row)
+        self.entries: Dict[str, Tuple[str, int]] = {}
+        self.shards: Dict[str, LatentShard] = {}
+        # Latents encoded since the last flush, grouped by shard
+        self.pending: Dict[str, Dict[str, torch.Tensor]] = {}
+        # Journal records waiting for the next flush
+        self.pending_records = []
+        self.pending_count = 0
+        self.dtype = None
+        # Bumped by compaction, so compacted shards never overwrite files the journal still points at
+        self.generation = 0
+        # Which journal file was read, and up to where, so refresh() only reads records added since
+        self.journal_id = None
+        self.journal_bytes = 0
+        self.lock = CacheLock(os.path.join(self.cache_dir, "index.lock"))
+        self.users = CacheLock(os.path.join(self.cache_dir, "users.lock"))
+        self.users.acquire(shared=True)
+        with self.lock:
+            self.refresh()
+            # Shards left behind by a compaction that ran while another process was using them
+            self.remove_stale_files()
+
+    def refresh(self):
+        """
+        Read the journal records written since the last refresh, by this process or any other.
+        Call with the lock held.
+        """
+        if not os.path.exists(self.journal_file):
+            return
+        stat = os.stat(self.journal_file)
+        journal_id = (stat.st_dev, stat.st_ino)
+        if journal_id != self.journal_id or stat.st_size < self.journal_bytes:
+            # Compacted by another process, start over
+            for shard in self.shards.values():
+                shard.close()
+            self.entries = {}
+            self.shards = {}
+            self.journal_id = journal_id
+            self.journal_bytes = 0
+        good_bytes = self.journal_bytes
+        new_keys = []
+        with open(self.journal_file, "rb") as f:
+            f.seek(good_bytes)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                good_bytes += len(line)
+                if "shape" in record:
+                    self.dtype = record["dtype"]
+                    self.generation = max(self.generation, record.get("generation", 0))
+                    path = os.path.join(self.cache_dir, record["file"])
+                    shard = self.shards.get(record["shard"])
+                    if shard is None or shard.path != path:
+                        self.shards[record["shard"]] = LatentShard(record["shard"], path, record["shape"], self.dtype)
+                elif record.get("deleted"):
+                    self.entries.pop(record["key"], None)
+                else:
+                    self.entries[record["key"]] = (record["shard"], record["row"])
+                    new_keys.append(record["key"])
+        if good_bytes != os.path.getsize(self.journal_file):
+            # A torn record at the end of the journal, from a run that died mid-write
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(good_bytes)
+        self.journal_bytes = good_bytes
+        for shard in self.shards.values():
+            shard.refresh()
+        # Only keep entries whose rows actually made it to disk
+        for key in new_keys:
+            location = self.entries.get(key)
+            if location is not None and (location[0] not in self.shards or
+                                         location[1] >= self.shards[location[0]].count):
+                del self.entries[key]
+
+    def sole_user(self) -> bool:
+        """
+        Whether no other process has this cache open. Always true on Windows, which refuses to delete
+        mapped files anyway.
+        """
+        if os.name == "nt":
+            return True
+        alone = self.users.acquire(blocking=False)
+        # A failed upgrade can drop the shared lock, so take it again either way
+        self.users.acquire(shared=True)
+        return alone
+
+    def remove_stale_files(self):
+        """
+        Delete shard files the journal doesn't point at, unless another process might still map them.
+        Call with the lock held.
+        """
+        if not self.sole_user():
+            return
+        live = {os.path.basename(shard.path) for shard in self.shards.values()}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".bin") and name not in live:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def __contains__(self, key: str) -> bool:
+        if key in self.entries:
+            return True
+        for pending in self.pending.values():
+            if key in pending:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.entries) + self.pending_count
+
+    def keys(self):
+        keys = set(self.entries.keys())
+        for pending in self.pending.values():
+            keys.update(pending.keys())
+        return keys
+
+    def dead_rows(self) -> int:
+        return sum(shard.count for shard in self.shards.values()) - len(self.entries)
+
+    def live_bytes(self) -> int:
+        return sum(self.shards[name].row_bytes for name, _ in self.entries.values())
+
+    def put(self, key: str, latents: torch.Tensor, name: str = None):
+        """
+        Queue latents for the store. The shard is named after the resolution they were encoded from,
+        unless a name is given.
+        """
+        latents = latents.detach().to("cpu")
+        if self.dtype is None:
+            self.dtype = _DTYPE_NAMES[latents.dtype]
+        elif _TORCH_DTYPES[self.dtype] != latents.dtype:
+            latents = latents.to(_TORCH_DTYPES[self.dtype])
+        if name is None:
+            # Latents are (C, H, W), so the shard is named after the pixel resolution they came from
+            name = shard_name((latents.shape[-1] * 8, latents.shape[-2] * 8))
+        pending = self.pending.setdefault(name, {})
+        if key not in pending:
+            self.pending_count += 1
+        pending[key] = latents
+        if self.pending_count >= self.flush_every:
+            self.flush()
+
+    def remove(self, key: str):
+        """
+        Tombstone an entry. Its row stays in the shard until the next compact().
+        """
+        for pending in self.pending.values():
+            if key in pending:
+                del pending[key]
+                self.pending_count -= 1
+        if key in self.entries:
+            del self.entries[key]
+            self.pending_records.append({"key": key, "deleted": True})
+
+    def get(self, key: str) -> torch.Tensor:
+        for pending in self.pending.values():
+            if key in pending:
+                return pending[key]
+        name, row = self.entries[key]
+        return self.shards[name].row(row)
+
+    def get_batch(self, keys: List[str]) -> torch.Tensor:
+        """
+        Fetch a batch of latents. When every key lives in the same shard this is a single slice (or a
+        single gather) of the mapped file instead of a stack of individual tensors.
+        """
+        locations = [self.entries.get(key) for key in keys]
+        if all(loc is not None for loc in locations) and len({loc[0] for loc in locations}) == 1:
+            return self.shards[locations[0][0]].rows([loc[1] for loc in locations])
+        return torch.stack([self.get(key) for key in keys])
+
+    def new_shard(self, name: str, shape: Tuple[int, ...]) -> LatentShard:
+        path = os.path.join(self.cache_dir, f"{name}.{self.generation}.bin")
+        if os.path.exists(path):
+            # Leftovers from a shard whose journal record never got written
+            os.remove(path)
+        return LatentShard(name, path, shape, self.dtype)
+
+    def shard_record(self, shard: LatentShard) -> dict:
+        return {
+            "shard": shard.name,
+            "file": os.path.basename(shard.path),
+            "shape": list(shard.shape),
+            "dtype": self.dtype,
+            "generation": self.generation
+        }
+
+    def flush(self):
+        """
+        Append pending latents to their shards, then journal them.
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.refresh()
+        # Tombstones may be for entries another process just journaled again, or that a reload brought back
+        for record in self.pending_records:
+            if record.get("deleted"):
+                self.entries.pop(record["key"], None)
+        for name, pending in self.pending.items():
+            if not len(pending):
+                continue
+            latents = torch.stack(list(pending.values()))
+            shard = self.shards.get(name)
+            if shard is None:
+                shard = self.new_shard(name, tuple(latents.shape[1:]))
+                self.shards[name] = shard
+                self.pending_records.append(self.shard_record(shard))
+            start = shard.append(latents)
+            for row, key in enumerate(pending.keys()):
+                self.entries[key] = (name, start + row)
+                self.pending_records.append({"key": key, "shard": name, "row": start + row})
+        self.pending = {}
+        self.pending_count = 0
+        if not len(self.pending_records):
+            return
+        with open(self.journal_file, "a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in self.pending_records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending_records = []
+        # Nobody else wrote while the lock was held, so the next refresh can skip these records
+        stat = os.stat(self.journal_file)
+        self.journal_id = (stat.st_dev, stat.st_ino)
+        self.journal_bytes = stat.st_size
+
+    def compact(self):
+        """
+        Rewrite every shard with only its live rows and start a fresh journal. New shard files are written
+        under a new generation, so a crash at any point leaves the journal pointing at complete data.
+        """
+        with self.lock:
+            self._flush()
+            if self.dead_rows():
+                self._compact()
+
+    def evict(self, max_bytes: int, in_use=()) -> int:
+        """
+        Remove the least recently used entries until the live rows fit in max_bytes, and compact the store
+        once removed rows add up to a quarter of the live ones. Keys in in_use are marked as used now and
+        never removed. Returns how many entries were removed.
+        """
+        with self.lock:
+            self._flush()
+            now = time.time()
+            used = {}
+            if os.path.exists(self.used_file):
+                try:
+                    with open(self.used_file, "r") as f:
+                        used = json.load(f)
+                except Exception as e:
+                    print(f"Exception loading cache use times: {e}")
+            # Entries without a time were added since the last eviction, by this process or another one
+            used = {key: used.get(key, now) for key in self.entries}
+            in_use = set(in_use)
+            for key in in_use:
+                if key in used:
+                    used[key] = now
+            total = self.live_bytes()
+            removed = 0
+            if total > max_bytes:
+                for key in sorted(used, key=used.get):
+                    if total <= max_bytes:
+                        break
+                    if key in in_use:
+                        continue
+                    total -= self.shards[self.entries[key][0]].row_bytes
+                    self.remove(key)
+                    del used[key]
+                    removed += 1
+                self._flush()
+                print(f"Removed {removed} least recently used entries from {self.cache_dir}.")
+            tmp_file = f"{self.used_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(used, f)
+            os.replace(tmp_file, self.used_file)
+            dead = self.dead_rows()
+            if dead and dead * 4 >= len(self.entries):
+                self._compact()
+        return removed
+
+    def _compact(self):
+        print(f"Compacting latent cache, reclaiming {self.dead_rows()} rows...")
+        self.generation += 1
+        old_shards = self.shards
+        new_shards = {}
+        new_entries = {}
+        records = []
+        for name, shard in old_shards.items():
+            live = sorted(((row, key) for key, (n, row) in self.entries.items() if n == name))
+            if not len(live):
+                continue
+            new_shard = self.new_shard(name, shard.shape)
+            records.append(self.shard_record(new_shard))
+            chunk = 1024
+            for i in range(0, len(live), chunk):
+                rows = [row for row, _ in live[i:i + chunk]]
+                new_shard.append(shard.rows(rows))
+            for new_row, (_, key) in enumerate(live):
+                new_entries[key] = (name, new_row)
+                records.append({"key": key, "shard": name, "row": new_row})
+            new_shards[name] = new_shard
+        tmp_file = f"{self.journal_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.journal_file)
+        stat = os.stat(self.journal_file)
+        self.journal_id = (stat.st_dev, stat.st_ino)
+        self.journal_bytes = stat.st_size
+        for shard in old_shards.values():
+            shard.close()
+        self.shards = new_shards
+        self.entries = new_entries
+        # Other processes reload the journal on their next flush, until then they may read the old shards
+        self.remove_stale_files()
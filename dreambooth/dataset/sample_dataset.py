@@ -1,10 +1,9 @@
 import os.path
 import random
 
-from PIL import Image
-
 from dreambooth.dataclasses.db_config import DreamboothConfig
 from dreambooth.dataclasses.prompt_data import PromptData
+from dreambooth.utils.image_manifest import manifest_for, save_manifests
 from dreambooth.utils.image_utils import get_images, FilenameTextGetter, \
     closest_resolution, make_bucket_resolutions
 
@@ -42,10 +41,10 @@ class SampleDataset:
                 for image in images:
                     file_text = getter.read_text(image)
                     prompt = getter.create_text(sample_prompt, file_text, concept, False)
-                    img = Image.open(image)
-                    res = img.size
+                    res = manifest_for(image).dims(image)
                     closest = closest_resolution(res[0], res[1], bucket_resos)
                     prompts.append((prompt, closest))
+                save_manifests()
             else:
                 prompts = [(sample_prompt, (config.resolution, config.resolution))]
             for i in range(required):
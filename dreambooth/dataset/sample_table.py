@@ -0,0 +1,48 @@
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class SampleTable:
+    """
+    Every sample in the dataset as one row of integer columns, addressed by sample ID.
+
+    Captions are interned, so repeated captions (like class prompts) are stored once, and a sample costs
+    a few bytes of columns on top of its path string.
+    """
+
+    def __init__(self):
+        self.paths: List[str] = []
+        self.captions: List[str] = []
+        self._caption_ids: Dict[str, int] = {}
+        # Columns grow as array buffers while the dataset is built, and become numpy arrays in freeze()
+        self.is_class = array("b")
+        self.caption = array("i")
+
+    def __len__(self):
+        return len(self.paths)
+
+    def caption_id(self, caption: str) -> int:
+        caption_id = self._caption_ids.get(caption)
+        if caption_id is None:
+            caption_id = len(self.captions)
+            self._caption_ids[caption] = caption_id
+            self.captions.append(caption)
+        return caption_id
+
+    def add(self, path: str, caption: str, is_class: bool) -> int:
+        self.paths.append(path)
+        self.is_class.append(is_class)
+        self.caption.append(self.caption_id(caption))
+        return len(self.paths) - 1
+
+    def freeze(self):
+        self.is_class = np.array(self.is_class, dtype=np.bool_)
+        self.caption = np.array(self.caption, dtype=np.int32)
+
+    def row(self, sample_id: int) -> Tuple[str, str, bool]:
+        """
+        Path, caption and whether it's a class image for one sample.
+        """
+        return self.paths[sample_id], self.captions[self.caption[sample_id]], bool(self.is_class[sample_id])
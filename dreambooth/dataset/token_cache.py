@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Union
+
+import numpy as np
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+from dreambooth import shared
+
+
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase, padding: Union[bool, str], add_special_tokens: bool) -> str:
+    """
+    Hash the vocabulary and tokenizing options, so a cache is only reused for identical token IDs.
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    sha.update(f"{tokenizer.model_max_length}_{padding}_{add_special_tokens}".encode())
+    return sha.hexdigest()[:16]
+
+
+def token_cache_file(tokenizer: PreTrainedTokenizerBase, padding: Union[bool, str], add_special_tokens: bool) -> str:
+    fingerprint = tokenizer_fingerprint(tokenizer, padding, add_special_tokens)
+    return os.path.join(shared.dreambooth_cache_path, "tokens", f"{fingerprint}.npz")
+
+
+def load_fast_tokenizer(tokenizer: PreTrainedTokenizerBase) -> Union[PreTrainedTokenizerBase, None]:
+    if tokenizer.is_fast:
+        return tokenizer
+    try:
+        fast_tokenizer = AutoTokenizer.from_pretrained(tokenizer.name_or_path, use_fast=True)
+        if fast_tokenizer.is_fast:
+            return fast_tokenizer
+    except Exception as e:
+        print(f"Exception loading fast tokenizer: {e}")
+    return None
+
+
+def batch_tokenize(
+        tokenizer: PreTrainedTokenizerBase,
+        captions: List[str],
+        padding: Union[bool, str],
+        add_special_tokens: bool,
+        parity_samples: int = 256
+) -> List[np.ndarray]:
+    """
+    Tokenize captions in one batched call of the fast tokenizer, after checking it against the slow one on an
+    even spread of captions plus any non-ASCII ones, where the two are most likely to disagree.
+    Falls back to the slow tokenizer if the fast one can't be loaded or doesn't match.
+    """
+
+    def tokenize(tok, texts):
+        # Each caption is padded on its own, not to the longest in the batch
+        return tok(texts, padding=padding if padding == "max_length" else False, truncation=True,
+                   add_special_tokens=add_special_tokens).input_ids
+
+    if not len(captions):
+        return []
+    fast_tokenizer = load_fast_tokenizer(tokenizer)
+    if fast_tokenizer is not None and fast_tokenizer is not tokenizer:
+        step = max(1, len(captions) // parity_samples)
+        check = set(range(0, len(captions), step))
+        check.update(i for i, caption in enumerate(captions) if not caption.isascii())
+        check = sorted(check)[:parity_samples * 4]
+        sample = [captions[i] for i in check]
+        mismatches = sum(a != b for a, b in zip(tokenize(tokenizer, sample), tokenize(fast_tokenizer, sample)))
+        if mismatches:
+            print(f"Fast tokenizer differs on {mismatches}/{len(sample)} captions, using the slow tokenizer.")
+            fast_tokenizer = None
+    return [np.array(ids, dtype=np.int32) for ids in tokenize(fast_tokenizer or tokenizer, captions)]
+
+
+class TokenCache:
+    """
+    Token IDs by caption, persisted between runs. Captions are stored by hash, IDs as one padded array.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self.entries: Dict[str, np.ndarray] = {}
+        self.dirty = False
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as data:
+                    for key, ids, length in zip(data["keys"], data["ids"], data["lengths"]):
+                        self.entries[key.decode()] = ids[:length]
+            except Exception as e:
+                print(f"Exception loading token cache: {e}")
+
+    @staticmethod
+    def key(caption: str) -> str:
+        return hashlib.sha1(caption.encode()).hexdigest()
+
+    def __contains__(self, caption: str) -> bool:
+        return self.key(caption) in self.entries
+
+    def get(self, caption: str) -> Union[np.ndarray, None]:
+        return self.entries.get(self.key(caption))
+
+    def put(self, caption: str, ids: np.ndarray):
+        self.entries[self.key(caption)] = ids
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty or not len(self.entries):
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        keys = list(self.entries.keys())
+        lengths = np.array([len(self.entries[key]) for key in keys], dtype=np.int32)
+        ids = np.zeros((len(keys), int(lengths.max())), dtype=np.int32)
+        for i, key in enumerate(keys):
+            ids[i, :lengths[i]] = self.entries[key]
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(f, keys=np.array(keys, dtype="S40"), ids=ids, lengths=lengths)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
@@ -159,6 +159,8 @@ class DreamState:
     need_restart = False
     time_left_force_display = False
     active = False
+    # Rolling timings of training and saving phases by phase name, with peak memory under "step" and "save"
+    timings = {}
 
     def interrupt(self):
         self.interrupted = True
@@ -187,7 +189,8 @@ class DreamState:
             "sampling_steps": self.sampling_steps,
             "last_status": self.textinfo,
             "sample_prompts": self.sample_prompts,
-            "active": self.active
+            "active": self.active,
+            "timings": self.timings
         }
 
         return obj
@@ -207,6 +210,7 @@ class DreamState:
         self.textinfo2 = None
         self.time_left_force_display = False
         self.active = True
+        self.timings = {}
         torch_gc()
 
     def end(self):
@@ -297,13 +301,15 @@ def load_vars(root_path = None):
     data_path, show_progress_every_n_steps, parallel_processing_allowed, dataset_filename_word_regex, dataset_filename_join_string, \
     device_id, state, disable_safe_unpickle, ckptfix, medvram, lowvram, debug, profile_db, sub_quad_q_chunk_size, sub_quad_kv_chunk_size, \
     sub_quad_chunk_threshold, CLIP_stop_at_last_layers, sd_model, config, force_cpu, paths, is_auto, device, orig_tensor_to, orig_layer_norm, \
-    orig_tensor_numpy, extension_path, orig_cumsum, orig_Tensor_cumsum, status, state
+    orig_tensor_numpy, extension_path, orig_cumsum, orig_Tensor_cumsum, status, state, dreambooth_cache_path
 
     script_path = os.sep.join(__file__.split(os.sep)[0:-4]) if root_path is None else root_path
     logger.debug(f"Script path is {script_path}")
     models_path = os.path.join(script_path, "models")
     embeddings_dir = os.path.join(script_path, "embeddings")
     dreambooth_models_path = os.path.join(models_path, "dreambooth")
+    # Caches that can be shared between models (latents, class images) live here
+    dreambooth_cache_path = os.path.join(models_path, "dreambooth_cache")
     ckpt_dir = os.path.join(models_path, "Stable-diffusion")
     ui_lora_models_path = os.path.join(models_path, "Lora")
     db_model_config = None
@@ -375,6 +381,7 @@ script_path = ""
 models_path = ""
 embeddings_dir = ""
 dreambooth_models_path = ""
+dreambooth_cache_path = ""
 ckpt_dir = ""
 ui_lora_models_path = ""
 db_model_config = None
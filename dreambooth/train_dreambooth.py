@@ -3,8 +3,8 @@
 # With some custom bits sprinkled in and some stuff from OG diffusers as well.
 
 import itertools
+import json
 import logging
-import math
 import os
 import time
 import traceback
@@ -35,6 +35,7 @@ from transformers import AutoTokenizer
 from dreambooth import shared
 from dreambooth.dataclasses.prompt_data import PromptData
 from dreambooth.dataclasses.train_result import TrainResult
+from dreambooth.dataset.batch_prefetcher import BatchPrefetcher
 from dreambooth.dataset.bucket_sampler import BucketSampler
 from dreambooth.dataset.sample_dataset import SampleDataset
 from dreambooth.deis_velocity import get_velocity
@@ -43,7 +44,9 @@ from dreambooth.memory import find_executable_batch_size
 from dreambooth.optimization import UniversalScheduler, get_optimizer, get_noise_scheduler
 from dreambooth.shared import status
 from dreambooth.utils.gen_utils import generate_classifiers, generate_dataset
-from dreambooth.utils.image_utils import db_save_image, get_scheduler_class
+from dreambooth.utils.image_utils import ImageWriter, get_scheduler_class
+from dreambooth.utils.loss_utils import sample_losses, weighted_loss
+from dreambooth.utils.metrics import MetricsAggregator, PhaseTimer
 from dreambooth.utils.model_utils import (
     unload_system_models,
     import_model_class_from_model_name_or_path,
@@ -52,15 +55,16 @@ from dreambooth.utils.model_utils import (
     xformerify,
     torch2ify,
 )
-from dreambooth.utils.text_utils import encode_hidden_state
+from dreambooth.utils.text_utils import encode_hidden_state, TextEmbeddingCache
 from dreambooth.utils.utils import cleanup, printm, verify_locon_installed
 from dreambooth.webhook import send_training_update
 from dreambooth.xattention import optim_to
-from helpers.ema_model import EMAModel
+from helpers.ema_model import EMAModel, OffloadedEMAModel
 from helpers.log_parser import LogParser
 from helpers.mytqdm import mytqdm
 from lora_diffusion.extra_networks import save_extra_networks
 from lora_diffusion.lora import (
+    extract_lora_ups_down,
     save_lora_weight,
     TEXT_ENCODER_DEFAULT_TARGET_REPLACE,
     get_target_module,
@@ -177,7 +181,7 @@ def main(
         stop_text_percentage = args.stop_text_encoder
         if not args.train_unet:
             stop_text_percentage = 1
-        n_workers = 0
+        n_workers = max(0, int(args.dataloader_workers))
         args.max_token_length = int(args.max_token_length)
         if not args.pad_tokens and args.max_token_length > 75:
             print("Cannot raise token length limit above 75 when pad_tokens=False")
@@ -355,7 +359,13 @@ def main(
                 text_encoder.to(accelerator.device, dtype=weight_dtype)
 
         ema_model = None
-        if args.use_ema:
+        # An offloaded EMA keeps its weights in host memory. With LoRA, EMA only follows the adapter weights,
+        # which are injected below, and is always offloaded.
+        ema_offload = args.ema_offload if args.ema_offload in ["fp32", "bf16"] else None
+        if args.use_ema and args.use_lora and ema_offload is None:
+            ema_offload = "fp32"
+        ema_dtype = torch.bfloat16 if ema_offload == "bf16" else torch.float32
+        if args.use_ema and not args.use_lora:
             if os.path.exists(
                     os.path.join(
                         args.pretrained_model_name_or_path,
@@ -369,17 +379,38 @@ def main(
                     revision=args.revision,
                     torch_dtype=torch.float32,
                 )
-                if args.attention == "xformers" and not shared.force_cpu:
-                    xformerify(ema_unet)
-
-                ema_model = EMAModel(
-                    ema_unet, device=accelerator.device, dtype=weight_dtype
-                )
+                if ema_offload is not None:
+                    ema_model = OffloadedEMAModel(
+                        EMAModel.named_tensors(ema_unet),
+                        dtype=ema_dtype,
+                        update_every=args.ema_update_every,
+                    )
+                else:
+                    if args.attention == "xformers" and not shared.force_cpu:
+                        xformerify(ema_unet)
+
+                    ema_model = EMAModel(
+                        ema_unet,
+                        device=accelerator.device,
+                        dtype=weight_dtype,
+                        update_every=args.ema_update_every,
+                    )
                 del ema_unet
+            elif ema_offload is not None:
+                ema_model = OffloadedEMAModel(
+                    EMAModel.named_tensors(unet),
+                    dtype=ema_dtype,
+                    update_every=args.ema_update_every,
+                )
             else:
                 ema_model = EMAModel(
-                    unet, device=accelerator.device, dtype=weight_dtype
+                    unet,
+                    device=accelerator.device,
+                    dtype=weight_dtype,
+                    update_every=args.ema_update_every,
                 )
+        if isinstance(ema_model, OffloadedEMAModel) and args.ema_predict:
+            print("Offloaded EMA weights can't be used for prediction, predicting with the unet.")
 
         if args.use_lora or not args.train_unet:
             unet.requires_grad_(False)
@@ -417,6 +448,21 @@ def main(
                     r=args.lora_txt_rank,
                     loras=lora_txt,
                 )
+            if args.use_ema:
+                def lora_tensors(model):
+                    # Same order as save_lora_weight
+                    tensors = {}
+                    for _up, _down in extract_lora_ups_down(model, target_replace_module=target_module):
+                        tensors[str(len(tensors))] = _up.weight
+                        tensors[str(len(tensors))] = _down.weight
+                    return tensors
+
+                ema_model = OffloadedEMAModel(
+                    lora_tensors(unet),
+                    dtype=ema_dtype,
+                    update_every=args.ema_update_every,
+                    select=lora_tensors,
+                )
             printm("Lora loaded")
             cleanup()
             printm("Cleaned")
@@ -491,7 +537,6 @@ def main(
             tokenizer=tokenizer,
             vae=vae if args.cache_latents else None,
             debug=False,
-            model_dir=args.model_dir,
         )
 
         printm("Dataset loaded.")
@@ -517,41 +562,24 @@ def main(
             stop_profiler(profiler)
             return result
 
-        def collate_fn(examples):
-            input_ids = [example["input_ids"] for example in examples]
-            pixel_values = [example["image"] for example in examples]
-            types = [example["is_class"] for example in examples]
-            weights = [
-                current_prior_loss_weight if example["is_class"] else 1.0
-                for example in examples
-            ]
-            loss_avg = 0
-            for weight in weights:
-                loss_avg += weight
-            loss_avg /= len(weights)
-            pixel_values = torch.stack(pixel_values)
-            if not args.cache_latents:
-                pixel_values = pixel_values.to(
-                    memory_format=torch.contiguous_format
-                ).float()
-            input_ids = torch.cat(input_ids, dim=0)
-
-            batch_data = {
-                "input_ids": input_ids,
-                "images": pixel_values,
-                "types": types,
-                "loss_avg": loss_avg,
-            }
-            return batch_data
-
         sampler = BucketSampler(train_dataset, train_batch_size)
 
+        loader_args = {}
+        if n_workers > 0:
+            # Keep workers alive between epochs, and have each one load the next batches ahead of the step
+            loader_args = {
+                "persistent_workers": True,
+                "prefetch_factor": args.dataloader_prefetch,
+                "pin_memory": accelerator.device.type == "cuda",
+            }
+
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=1,
             batch_sampler=sampler,
-            collate_fn=collate_fn,
+            collate_fn=train_dataset.collate_fn,
             num_workers=n_workers,
+            **loader_args,
         )
 
         max_train_steps = args.num_train_epochs * len(train_dataset)
@@ -578,21 +606,19 @@ def main(
         )
 
         # create ema, fix OOM
-        if args.use_ema:
+        if isinstance(ema_model, EMAModel):
             if stop_text_percentage != 0:
                 (
                     ema_model.model,
                     unet,
                     text_encoder,
                     optimizer,
-                    train_dataloader,
                     lr_scheduler,
                 ) = accelerator.prepare(
                     ema_model.model,
                     unet,
                     text_encoder,
                     optimizer,
-                    train_dataloader,
                     lr_scheduler,
                 )
             else:
@@ -600,10 +626,9 @@ def main(
                     ema_model.model,
                     unet,
                     optimizer,
-                    train_dataloader,
                     lr_scheduler,
                 ) = accelerator.prepare(
-                    ema_model.model, unet, optimizer, train_dataloader, lr_scheduler
+                    ema_model.model, unet, optimizer, lr_scheduler
                 )
         else:
             if stop_text_percentage != 0:
@@ -611,16 +636,19 @@ def main(
                     unet,
                     text_encoder,
                     optimizer,
-                    train_dataloader,
                     lr_scheduler,
                 ) = accelerator.prepare(
-                    unet, text_encoder, optimizer, train_dataloader, lr_scheduler
+                    unet, text_encoder, optimizer, lr_scheduler
                 )
             else:
-                unet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-                    unet, optimizer, train_dataloader, lr_scheduler
+                unet, optimizer, lr_scheduler = accelerator.prepare(
+                    unet, optimizer, lr_scheduler
                 )
 
+        # Batches are moved to the device by the prefetcher, from pinned memory and ahead of the step
+        train_dataloader = accelerator.prepare_data_loader(train_dataloader, device_placement=False)
+        train_batches = BatchPrefetcher(train_dataloader, accelerator.device, args.device_prefetch)
+
         if not args.cache_latents and vae is not None:
             vae.to(accelerator.device, dtype=weight_dtype)
 
@@ -668,6 +696,12 @@ def main(
                 resume_from_checkpoint = True
                 first_epoch = args.epoch
                 global_epoch = first_epoch
+                sampler_state = os.path.join(new_hotness, "sampler.json")
+                if os.path.exists(sampler_state):
+                    with open(sampler_state, "r") as f:
+                        sampler.load_state_dict(json.load(f))
+                    # The sampler picks up at the next batch itself, so there is nothing to skip
+                    resume_step = 0
             except Exception as lex:
                 print(f"Exception loading checkpoint: {lex}")
 
@@ -688,6 +722,8 @@ def main(
         print(f"  Lora: {args.use_lora}, Optimizer: {args.optimizer}, Prec: {precision}")
         print(f"  Gradient Checkpointing: {args.gradient_checkpointing}")
         print(f"  EMA: {args.use_ema}")
+        if isinstance(ema_model, OffloadedEMAModel):
+            print(f"  EMA Offload: {ema_offload}")
         print(f"  UNET: {args.train_unet}")
         print(f"  Freeze CLIP Normalization Layers: {args.freeze_clip_normalization}")
         print(f"  LR: {args.learning_rate}")
@@ -773,6 +809,9 @@ def main(
 
             return save_model
 
+        # Save phases are timed on the wall clock, they wait on the GPU anyway
+        save_timer = PhaseTimer(accelerator.device, use_events=False)
+
         def save_weights(
                 save_image, save_model, save_snapshot, save_checkpoint, save_lora
         ):
@@ -791,6 +830,7 @@ def main(
 
             # Create the pipeline using the trained modules and save it.
             if accelerator.is_main_process:
+                save_timer.mark()
                 printm("Pre-cleanup.")
                 
                 # Save random states so sample generation doesn't impact training.
@@ -834,6 +874,7 @@ def main(
                     s_pipeline.scheduler.config.solver_type = "bh2"
 
                 s_pipeline = s_pipeline.to(accelerator.device)
+                save_timer.lap("save_pipeline")
 
                 with accelerator.autocast(), torch.inference_mode():
                     if save_model:
@@ -848,14 +889,17 @@ def main(
                                     status.textinfo = (
                                         f"Saving snapshot at step {args.revision}..."
                                     )
-                                    accelerator.save_state(
-                                        os.path.join(
-                                            args.model_dir,
-                                            "checkpoints",
-                                            f"checkpoint-{args.revision}",
-                                        )
+                                    checkpoint_dir = os.path.join(
+                                        args.model_dir,
+                                        "checkpoints",
+                                        f"checkpoint-{args.revision}",
                                     )
+                                    accelerator.save_state(checkpoint_dir)
+                                    # Keep the batch plan with the snapshot, so resuming continues at the same batch
+                                    with open(os.path.join(checkpoint_dir, "sampler.json"), "w") as f:
+                                        json.dump(sampler.state_dict(), f)
                                     pbar.update()
+                                    save_timer.lap("save_snapshot")
 
                                 # We should save this regardless, because it's our fallback if no snapshot exists.
                                 status.textinfo = (
@@ -875,6 +919,7 @@ def main(
                                         safe_serialization=True,
                                     )
                                 pbar.update()
+                                save_timer.lap("save_pretrained")
 
                             elif save_lora:
                                 pbar.set_description("Saving Lora Weights...")
@@ -898,6 +943,8 @@ def main(
                                     "module", args.use_lora_extended
                                 )
                                 save_lora_weight(s_pipeline.unet, out_file, tgt_module)
+                                if ema_model is not None:
+                                    ema_model.save_lora(out_file.replace(".pt", "_ema.pt"))
 
                                 modelmap = {"unet": (s_pipeline.unet, tgt_module)}
                                 # save text_encoder
@@ -924,6 +971,7 @@ def main(
                                         f"{lora_file_prefix}.safetensors",
                                     )
                                     save_extra_networks(modelmap, out_safe)
+                                save_timer.lap("save_lora")
                             # package pt into checkpoint
                             if save_checkpoint:
                                 pbar.set_description("Compiling Checkpoint")
@@ -933,6 +981,7 @@ def main(
                                 else:
                                     compile_checkpoint(args.model_name, reload_models=False, lora_file_name=out_file,
                                                        log=False, snap_rev=snap_rev, pbar=pbar)
+                                save_timer.lap("compile_checkpoint")
 
                                 printm("Restored, moved to acc.device.")
                         except Exception as ex:
@@ -949,6 +998,7 @@ def main(
                         status.textinfo = (
                             f"Saving preview image(s) at step {args.revision}..."
                         )
+                        writer = ImageWriter(compress_level=args.png_compress_level)
                         try:
                             s_pipeline.set_progress_bar_config(disable=True)
                             sample_dir = os.path.join(save_dir, "samples")
@@ -983,20 +1033,21 @@ def main(
                                         generator=generator,
                                     ).images[0]
                                     sample_prompts.append(c.prompt)
-                                    image_name = db_save_image(
+                                    samples.append(writer.save(
                                         s_image,
                                         c,
                                         custom_name=f"sample_{args.revision}-{ci}",
-                                    )
-                                    shared.status.current_image = image_name
+                                    ))
+                                    shared.status.current_image = s_image
                                     shared.status.sample_prompts = [c.prompt]
-                                    samples.append(image_name)
                                     pbar.update()
                                     ci += 1
-                                for sample in samples:
-                                    last_samples.append(sample)
-                                for prompt in sample_prompts:
-                                    last_prompts.append(prompt)
+                                # Samples are read back from disk below, wait for them to be written
+                                writer.close()
+                                for sample, prompt in zip(samples, sample_prompts):
+                                    if sample.exception() is None:
+                                        last_samples.append(sample.result())
+                                        last_prompts.append(prompt)
                                 del samples
                                 del prompts
 
@@ -1004,11 +1055,15 @@ def main(
                             print(f"Exception saving sample: {em}")
                             traceback.print_exc()
                             pass
+                        finally:
+                            writer.close()
+                        save_timer.lap("save_samples")
                 printm("Starting cleanup.")
                 del s_pipeline
                 if save_image:
                     if "generator" in locals():
                         del generator
+                    save_timer.mark()
                     try:
                         printm("Parse logs.")
                         log_images, log_names = log_parser.parse_logs(
@@ -1036,6 +1091,7 @@ def main(
                     status.sample_prompts = last_prompts
                     status.current_image = last_samples
                     pbar.update()
+                    save_timer.lap("parse_logs")
 
                 if args.cache_latents:
                     printm("Unloading vae.")
@@ -1048,13 +1104,19 @@ def main(
 
                 optim_to(profiler, optimizer, accelerator.device)
 
+                # The pipeline moved the text encoder back, keep it off the device while the cache serves it
+                if text_embedding_cache is not None and text_embedding_cache.offloaded:
+                    text_encoder.to("cpu")
+
                 # Restore all random states to avoid having sampling impact training.
                 if shared.device.type == 'cuda':
                     torch.set_rng_state(torch_rng_state)
                     torch.cuda.set_rng_state(cuda_cpu_rng_state, device="cpu")
                     torch.cuda.set_rng_state(cuda_gpu_rng_state, device="cuda")
 
+                save_timer.sample_memory("save")
                 cleanup()
+                status.timings = {**phase_timer.summary(), **save_timer.summary()}
                 printm("Completed saving weights.")
 
         # Only show the progress bar once on each machine.
@@ -1080,6 +1142,30 @@ def main(
         last_tenc = 0 < text_encoder_epochs
         if stop_text_percentage == 0:
             last_tenc = False
+        text_embedding_cache = None
+        metrics = MetricsAggregator(args.metrics_flush_steps, args.metrics_flush_seconds)
+        # Where the time of each training step and each save goes, for the logs and the status API
+        phase_timer = PhaseTimer(accelerator.device)
+
+        def flush_metrics():
+            means = metrics.flush()
+            if not len(means):
+                return
+            allocated = round(torch.cuda.memory_allocated(0) / 1024 ** 3, 1)
+            cached = round(torch.cuda.memory_reserved(0) / 1024 ** 3, 1)
+            last_lr = lr_scheduler.get_last_lr()[0]
+            epoch_loss = means.pop("epoch_loss", None)
+            logs = {"lr": float(last_lr), **means, "vram": float(cached)}
+            status.textinfo2 = (
+                f"Loss: {'%.2f' % logs['loss']}, LR: {'{:.2E}'.format(Decimal(last_lr))}, "
+                f"VRAM: {allocated}/{cached} GB"
+            )
+            progress_bar.set_postfix(**logs)
+            logs.update(phase_timer.log_values())
+            accelerator.log(logs, step=args.revision)
+            if epoch_loss is not None:
+                accelerator.log({"epoch_loss": epoch_loss / len(train_dataloader)}, step=global_step)
+            status.timings = {**phase_timer.summary(), **save_timer.summary()}
 
         for epoch in range(first_epoch, max_train_epochs):
             callback_at_epoch_begins(epoch)
@@ -1105,16 +1191,34 @@ def main(
             elif train_tenc:
                 text_encoder.text_model.embeddings.requires_grad_(True)
 
+            if not train_tenc and args.cache_text_embeddings and text_embedding_cache is None:
+                text_embedding_cache = TextEmbeddingCache(
+                    False,
+                    args.max_token_length,
+                    tokenizer.model_max_length,
+                    args.clip_skip,
+                )
+                # Without tag shuffling every caption is known up front, so the encoder can leave the device
+                if not args.shuffle_tags and text_embedding_cache.precompute(
+                        text_encoder, list(train_dataset.caption_cache.values())
+                ):
+                    text_encoder.to("cpu")
+                    text_embedding_cache.offloaded = True
+                    cleanup()
+                print(f"Caching text embeddings, {len(text_embedding_cache)} precomputed.")
+
             if last_tenc != train_tenc:
                 last_tenc = train_tenc
                 cleanup()
 
-            loss_total = 0
+            metrics.reset_epoch()
 
             current_prior_loss_weight = current_prior_loss(
                 args, current_epoch=global_epoch
             )
-            for step, batch in enumerate(train_dataloader):
+            phase_timer.mark()
+            for step, batch in enumerate(train_batches):
+                sampler.consumed += accelerator.num_processes
                 # Skip steps until we reach the resumed step
                 if (
                         resume_from_checkpoint
@@ -1125,8 +1229,11 @@ def main(
                     progress_bar.reset()
                     status.job_count = max_train_steps
                     status.job_no += train_batch_size
+                    phase_timer.mark()
                     continue
 
+                phase_timer.lap("data_wait", host=True)
+                phase_timer.add("collate", train_batches.last_load)
                 with accelerator.accumulate(unet), accelerator.accumulate(text_encoder):
                     # Convert images to latent space
                     with torch.no_grad():
@@ -1137,6 +1244,7 @@ def main(
                                 batch["images"].to(dtype=weight_dtype)
                             ).latent_dist.sample()
                         latents = latents * 0.18215
+                    phase_timer.lap("latents")
 
                     # Sample noise that we'll add to the latents
                     if args.offset_noise < 0:
@@ -1166,18 +1274,24 @@ def main(
                     # (this is the forward diffusion process)
                     noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
                     pad_tokens = args.pad_tokens if train_tenc else False
-                    encoder_hidden_states = encode_hidden_state(
-                        text_encoder,
-                        batch["input_ids"],
-                        pad_tokens,
-                        b_size,
-                        args.max_token_length,
-                        tokenizer.model_max_length,
-                        args.clip_skip,
-                    )
+                    if text_embedding_cache is not None:
+                        encoder_hidden_states = text_embedding_cache.encode(
+                            text_encoder, batch["input_ids"], latents.device, batch["caption_keys"]
+                        )
+                    else:
+                        encoder_hidden_states = encode_hidden_state(
+                            text_encoder,
+                            batch["input_ids"],
+                            pad_tokens,
+                            b_size,
+                            args.max_token_length,
+                            tokenizer.model_max_length,
+                            args.clip_skip,
+                        )
+                    phase_timer.lap("text_encode")
 
                     # Predict the noise residual
-                    if args.use_ema and args.ema_predict:
+                    if isinstance(ema_model, EMAModel) and args.ema_predict:
                         noise_pred = ema_model(
                             noisy_latents, timesteps, encoder_hidden_states
                         ).sample
@@ -1185,6 +1299,7 @@ def main(
                         noise_pred = unet(
                             noisy_latents, timesteps, encoder_hidden_states
                         ).sample
+                    phase_timer.lap("unet_forward")
 
                     # Get the target for loss depending on the prediction type
                     if noise_scheduler.config.prediction_type == "v_prediction":
@@ -1192,61 +1307,18 @@ def main(
                     else:
                         target = noise
 
-                    if not args.split_loss:
-                        loss = instance_loss = torch.nn.functional.mse_loss(
-                            noise_pred.float(), target.float(), reduction="mean"
-                        )
-                        loss *= batch["loss_avg"]
-
-                    else:
-                        model_pred_chunks = torch.split(noise_pred, 1, dim=0)
-                        target_pred_chunks = torch.split(target, 1, dim=0)
-                        instance_chunks = []
-                        prior_chunks = []
-                        instance_pred_chunks = []
-                        prior_pred_chunks = []
-
-                        # Iterate over the list of boolean values in batch["types"]
-                        for i, is_prior in enumerate(batch["types"]):
-                            # If is_prior is False, append the corresponding chunk to instance_chunks
-                            if not is_prior:
-                                instance_chunks.append(model_pred_chunks[i])
-                                instance_pred_chunks.append(target_pred_chunks[i])
-                            # If is_prior is True, append the corresponding chunk to prior_chunks
-                            else:
-                                prior_chunks.append(model_pred_chunks[i])
-                                prior_pred_chunks.append(target_pred_chunks[i])
-
-                        # initialize with 0 in case we are having batch = 1
-                        instance_loss = torch.tensor(0)
-                        prior_loss = torch.tensor(0)
-
-                        # Concatenate the chunks in instance_chunks to form the model_pred_instance tensor
-                        if len(instance_chunks):
-                            model_pred = torch.stack(instance_chunks, dim=0)
-                            target = torch.stack(instance_pred_chunks, dim=0)
-                            instance_loss = torch.nn.functional.mse_loss(
-                                model_pred.float(), target.float(), reduction="mean"
-                            )
-
-                        if len(prior_pred_chunks):
-                            model_pred_prior = torch.stack(prior_chunks, dim=0)
-                            target_prior = torch.stack(prior_pred_chunks, dim=0)
-                            prior_loss = torch.nn.functional.mse_loss(
-                                model_pred_prior.float(),
-                                target_prior.float(),
-                                reduction="mean",
-                            )
-
-                        if len(instance_chunks) and len(prior_chunks):
-                            # Add the prior loss to the instance loss.
-                            loss = instance_loss + current_prior_loss_weight * prior_loss
-                        elif len(instance_chunks):
-                            loss = instance_loss
-                        else:
-                            loss = prior_loss * current_prior_loss_weight
+                    loss_terms = weighted_loss(
+                        sample_losses(noise_pred, target),
+                        batch["types"],
+                        current_prior_loss_weight,
+                        split_loss=args.split_loss
+                    )
+                    loss = loss_terms.loss
+                    instance_loss = loss_terms.instance_loss
+                    prior_loss = loss_terms.prior_loss
 
                     accelerator.backward(loss)
+                    phase_timer.lap("backward")
 
                     if accelerator.sync_gradients and not args.use_lora:
                         if train_tenc:
@@ -1256,18 +1328,17 @@ def main(
                         accelerator.clip_grad_norm_(params_to_clip, 1)
 
                     optimizer.step()
+                    phase_timer.lap("optimizer")
                     lr_scheduler.step(train_batch_size)
+                    phase_timer.lap("scheduler")
                     if args.use_ema and ema_model is not None:
                         ema_model.step(unet)
+                        phase_timer.lap("ema")
                     if profiler is not None:
                         profiler.step()
 
                     optimizer.zero_grad(set_to_none=args.gradient_set_to_none)
 
-                allocated = round(torch.cuda.memory_allocated(0) / 1024 ** 3, 1)
-                cached = round(torch.cuda.memory_reserved(0) / 1024 ** 3, 1)
-                last_lr = lr_scheduler.get_last_lr()[0]
-
                 global_step += train_batch_size
                 args.revision += train_batch_size
                 status.job_no += train_batch_size
@@ -1280,33 +1351,15 @@ def main(
                 del noisy_latents
                 del target
 
-                loss_step = loss.detach().item()
-                loss_total += loss_step
+                # Metrics stay on the device until the aggregator flushes them
                 if args.split_loss:
-                    logs = {
-                        "lr": float(last_lr),
-                        "loss": float(loss_step),
-                        "inst_loss": float(instance_loss.detach().item()),
-                        "prior_loss": float(prior_loss.detach().item()),
-                        "vram": float(cached),
-                    }
+                    metrics.add(loss=loss, inst_loss=instance_loss, prior_loss=prior_loss,
+                                data_wait=train_batches.last_wait)
                 else:
-                    logs = {
-                        "lr": float(last_lr),
-                        "loss": float(loss_step),
-                        "vram": float(cached),
-                    }
-
-                status.textinfo2 = (
-                    f"Loss: {'%.2f' % loss_step}, LR: {'{:.2E}'.format(Decimal(last_lr))}, "
-                    f"VRAM: {allocated}/{cached} GB"
-                )
+                    metrics.add(loss=loss, data_wait=train_batches.last_wait)
                 progress_bar.update(train_batch_size)
-                progress_bar.set_postfix(**logs)
-                accelerator.log(logs, step=args.revision)
-
-                logs = {"epoch_loss": loss_total / len(train_dataloader)}
-                accelerator.log(logs, step=global_step)
+                if metrics.should_flush() or training_complete or status.interrupted:
+                    flush_metrics()
 
                 status.job_count = max_train_steps
                 status.job_no = global_step
@@ -1315,9 +1368,11 @@ def main(
                     f" {args.revision}/{lifetime_step + max_train_steps} (Lifetime), Epoch: {global_epoch}"
                 )
 
-                if math.isnan(loss_step):
+                if metrics.nonfinite:
                     print("Loss is NaN, your model is dead. Cancelling training.")
                     status.interrupted = True
+                phase_timer.lap("logging", host=True)
+                phase_timer.sample_memory()
 
                 # Log completion message
                 if training_complete or status.interrupted:
@@ -1334,6 +1389,10 @@ def main(
 
                     break
 
+            flush_metrics()
+            if metrics.nonfinite and not status.interrupted:
+                print("Loss is NaN, your model is dead. Cancelling training.")
+                status.interrupted = True
             accelerator.wait_for_everyone()
 
             args.epoch += 1
@@ -1376,6 +1435,11 @@ def main(
                             break
                         time.sleep(1)
 
+        print(train_batches.stats())
+        print(phase_timer.stats())
+        if isinstance(ema_model, OffloadedEMAModel):
+            print(ema_model.stats())
+            ema_model.close()
         cleanup_memory()
         accelerator.end_training()
         result.msg = msg
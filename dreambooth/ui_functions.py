@@ -27,6 +27,7 @@ from dreambooth.optimization import UniversalScheduler
 from dreambooth.sd_to_diff import extract_checkpoint
 from dreambooth.shared import status, run
 from dreambooth.utils.gen_utils import generate_dataset, generate_classifiers
+from dreambooth.utils.image_manifest import save_manifests
 from dreambooth.utils.image_utils import (
     get_images,
     db_save_image,
@@ -169,6 +170,7 @@ def performance_wizard(model_name):
     stop_text_encoder: Whether to train text encoder or not.
     use_lora: Train using LORA. Better than "use CPU".
     use_ema: Train using EMA.
+    ema_offload: Keep EMA weights in host memory.
     msg: Stuff to show in the UI
     """
     attention = "flash_attention"
@@ -182,6 +184,7 @@ def performance_wizard(model_name):
     stop_text_encoder = 0
     use_lora = False
     use_ema = False
+    ema_offload = "none"
     config = None
     if model_name == "" or model_name is None:
         print("Can't load config, specify a model name!")
@@ -247,7 +250,8 @@ def performance_wizard(model_name):
         if 24 > gb >= 16:
             use_ema = True
         if 16 > gb >= 12:
-            use_ema = False
+            use_ema = True
+            ema_offload = "bf16"
             cache_latents = False
             gradient_accumulation_steps = 1
             train_batch_size = 1
@@ -272,6 +276,7 @@ def performance_wizard(model_name):
         "Text Encoder Ratio": stop_text_encoder,
         "Optimizer": optimizer,
         "EMA": use_ema,
+        "EMA Offload": ema_offload,
         "LORA": use_lora,
     }
     for key in log_dict:
@@ -288,6 +293,7 @@ def performance_wizard(model_name):
         stop_text_encoder,
         use_lora,
         use_ema,
+        ema_offload,
         save_samples_every,
         save_weights_every,
         msg,
@@ -875,6 +881,7 @@ def start_crop(
         else:
             out_paths[reso] = [img]
         out_counts[reso] = len(out_paths[reso])
+    save_manifests()
 
     def sort_key(res):
         # Sort by square resolutions first
@@ -1031,7 +1038,6 @@ def debug_buckets(model_name, num_epochs, batch_size):
         class_paths,
         batch_size,
         debug=True,
-        model_dir=args.model_dir,
     )
 
     placeholder = [torch.Tensor(10, 20)]
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+from typing import Dict, Union
+
+from dreambooth import shared
+from dreambooth.dataclasses.db_config import DreamboothConfig
+from dreambooth.dataclasses.prompt_data import PromptData
+from dreambooth.dataset.latent_cache import ContentHasher
+
+# Files in a model component folder that change what it generates
+_MODEL_FILE_EXTENSIONS = (".safetensors", ".bin", ".ckpt", ".json", ".txt")
+
+
+def class_seed(class_dir: str, prompt: str, negative_prompt: str, index: int) -> int:
+    """
+    Seed for the index-th class image of a prompt in class_dir. Seeds only depend on the folder and the prompts,
+    so every model asking for the same class images in the same folder asks for the same seeds, and can reuse
+    each other's images, while concepts with the same class prompt in different folders get different images.
+    """
+    class_dir = os.path.normcase(os.path.abspath(class_dir))
+    return zlib.crc32(f"{class_dir}\n{prompt}\n{negative_prompt}\n{index}".encode())
+
+
+def link_or_copy(src: str, dst: str):
+    """
+    Hard link src to dst, or copy it when the two aren't on the same file system.
+    """
+    tmp_file = f"{dst}.tmp"
+    try:
+        os.link(src, tmp_file)
+    except OSError:
+        shutil.copyfile(src, tmp_file)
+    os.replace(tmp_file, dst)
+
+
+def model_fingerprint(config: DreamboothConfig, hasher: ContentHasher) -> Union[str, None]:
+    """
+    Hash the files of the model components ImageBuilder loads for native generation: unet (or the EMA unet
+    when inferring with it), text encoder, tokenizer and VAE. Returns None when one of them isn't a local folder.
+    """
+    model_dir = config.pretrained_model_name_or_path
+    unet_path = os.path.join(model_dir, "unet")
+    if config.infer_ema and os.path.isfile(os.path.join(model_dir, "ema_unet", "diffusion_pytorch_model.safetensors")):
+        unet_path = os.path.join(model_dir, "ema_unet")
+    vae_path = config.pretrained_vae_name_or_path or os.path.join(model_dir, "vae")
+    sha = hashlib.sha1()
+    for directory in [unet_path, os.path.join(model_dir, "text_encoder"), os.path.join(model_dir, "tokenizer"), vae_path]:
+        if not os.path.isdir(directory):
+            return None
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(_MODEL_FILE_EXTENSIONS):
+                sha.update(name.encode())
+                # File hashes are remembered by size and mtime, so unchanged weights are only read once
+                sha.update(hasher.hash(os.path.join(directory, name)).encode())
+    return sha.hexdigest()
+
+
+class ClassImageCache:
+    """
+    Generated class images shared between models, keyed by everything that determines the image: model
+    fingerprint, prompt, negative prompt, steps, scale, scheduler, resolution and seed.
+
+    Images are hard linked into (or copied to) a model's class folder instead of being generated again. When the
+    cache grows past max_bytes, the least recently used images are removed from it.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.cache_dir = os.path.join(shared.dreambooth_cache_path, "class_images")
+        self.index_file = os.path.join(self.cache_dir, "index.json")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # key -> {"file": name of the image in the class folder, "size": bytes, "used": last use time}
+        self.entries: Dict[str, dict] = {}
+        self.dirty = False
+        self.hits = 0
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"Exception loading class image cache: {e}")
+        # Forget images removed from the cache folder by hand
+        missing = [key for key in self.entries if not os.path.exists(self.image_path(key))]
+        for key in missing:
+            del self.entries[key]
+        self.dirty = len(missing) > 0
+        self.hasher = ContentHasher(os.path.join(self.cache_dir, "file_hashes.json"))
+
+    def image_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    @staticmethod
+    def key(fingerprint: str, scheduler: str, prompt_data: PromptData) -> str:
+        data = [
+            fingerprint,
+            prompt_data.prompt,
+            prompt_data.negative_prompt,
+            prompt_data.steps,
+            prompt_data.scale,
+            scheduler,
+            list(prompt_data.resolution),
+            prompt_data.seed,
+            # Half precision on the GPU and full precision on the CPU don't make the same pixels
+            shared.device.type
+        ]
+        return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+    def fetch(self, key: str, prompt_data: PromptData) -> Union[str, None]:
+        """
+        Put the cached image for key into prompt_data.out_dir, along with its caption file, and return its path.
+        Returns None if the image isn't cached.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        dst = os.path.join(prompt_data.out_dir, entry["file"])
+        try:
+            if not os.path.exists(dst):
+                link_or_copy(self.image_path(key), dst)
+            txt_file = os.path.splitext(dst)[0] + ".txt"
+            if not os.path.exists(txt_file):
+                with open(f"{txt_file}.tmp", "w", encoding="utf8") as file:
+                    file.write(prompt_data.prompt)
+                os.replace(f"{txt_file}.tmp", txt_file)
+        except OSError as e:
+            print(f"Exception reusing class image: {e}")
+            return None
+        entry["used"] = time.time()
+        self.dirty = True
+        self.hits += 1
+        return dst
+
+    def add(self, key: str, image_path: str):
+        try:
+            cached = self.image_path(key)
+            if not os.path.exists(cached):
+                link_or_copy(image_path, cached)
+            self.entries[key] = {
+                "file": os.path.basename(image_path),
+                "size": os.path.getsize(cached),
+                "used": time.time()
+            }
+            self.dirty = True
+        except OSError as e:
+            print(f"Exception caching class image: {e}")
+
+    def evict(self):
+        """
+        Remove the least recently used images until the cache fits in max_bytes.
+        """
+        total = sum(entry["size"] for entry in self.entries.values())
+        if total <= self.max_bytes:
+            return
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["used"]):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.image_path(key))
+            except OSError:
+                pass
+            del self.entries[key]
+            total -= entry["size"]
+            self.dirty = True
+
+    def save(self):
+        self.evict()
+        try:
+            self.hasher.save()
+            if not self.dirty:
+                return
+            tmp_file = f"{self.index_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.index_file)
+            self.dirty = False
+        except Exception as e:
+            print(f"Exception saving class image cache: {e}")
@@ -2,6 +2,7 @@ import os
 import traceback
 from typing import List
 
+import torch
 from accelerate import Accelerator
 from transformers import AutoTokenizer
 
@@ -10,15 +11,17 @@ from dreambooth.dataclasses.db_config import DreamboothConfig, from_file
 from dreambooth.dataclasses.prompt_data import PromptData
 from dreambooth.dataset.class_dataset import ClassDataset
 from dreambooth.dataset.db_dataset import DbDataset
+from dreambooth.dataset.latent_cache import LatentCache, ContentHasher, latent_key, latent_cache_dir
 from dreambooth.shared import status
-from dreambooth.utils.image_utils import db_save_image
+from dreambooth.utils.class_image_cache import ClassImageCache, model_fingerprint
+from dreambooth.utils.image_utils import ImageWriter
 from dreambooth.utils.utils import cleanup
 from helpers.image_builder import ImageBuilder
 from helpers.mytqdm import mytqdm
 
 
 def generate_dataset(model_name: str, instance_prompts: List[PromptData] = None, class_prompts: List[PromptData] = None,
-                     batch_size=None, tokenizer=None, vae=None, debug=True, model_dir=""):
+                     batch_size=None, tokenizer=None, vae=None, debug=True):
     if debug:
         print("Generating dataset.")
     from dreambooth.ui_functions import gr_update
@@ -64,7 +67,11 @@ def generate_dataset(model_name: str, instance_prompts: List[PromptData] = None,
         strict_tokens=args.strict_tokens,
         not_pad_tokens=not args.pad_tokens,
         debug_dataset=debug,
-        model_dir=model_dir
+        cache_workers=args.cache_workers,
+        vae_batch_size=args.vae_batch_size,
+        latent_crop_margin=args.latent_crop_margin,
+        cache_decoded_images=args.cache_decoded_images,
+        latent_cache_size=args.latent_cache_size
     )
     train_dataset.make_buckets_with_caching(vae)
 
@@ -105,13 +112,42 @@ def generate_classifiers(
         else:
             return 0, instance_prompts, class_prompts
 
+    # Reuse class images already generated for other models with the same weights, prompts and settings
+    class_cache = None
+    fingerprint = None
+    reused = 0
+    if args.class_cache_size > 0 and class_gen_method == "Native Diffusers" and \
+            not (args.use_lora and args.lora_model_name) and prompt_dataset.__len__() > 0:
+        try:
+            class_cache = ClassImageCache(int(args.class_cache_size * 1024 ** 3))
+            fingerprint = model_fingerprint(args, class_cache.hasher)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Exception opening class image cache: {e}")
+        if fingerprint is None:
+            class_cache = None
+    if class_cache is not None:
+        status.textinfo = "Checking class image cache..."
+        found = []
+        for pd in prompt_dataset.generation_plan:
+            image_path = class_cache.fetch(class_cache.key(fingerprint, args.scheduler, pd), pd)
+            if image_path is not None:
+                pd.src_image = image_path
+                class_prompts.append(pd)
+                found.append(pd)
+        if len(found):
+            prompt_dataset.remove_prompts(found)
+            reused = len(found)
+            print(f"Reused {reused} cached class images.")
+        class_cache.save()
+
     set_len = prompt_dataset.__len__()
     if set_len == 0:
         print("Nothing to generate.")
         if ui:
-            return 0, []
+            return reused, []
         else:
-            return 0, instance_prompts, class_prompts
+            return reused, instance_prompts, class_prompts
 
     print(f"Generating {set_len} class images for training...")
     pbar = mytqdm(total=set_len, desc=f"Generating class images 0/{set_len}:", position=0)
@@ -128,69 +164,106 @@ def generate_classifiers(
         source_checkpoint=args.src
     )
 
-    generated = 0
-    actual_idx = 0
-    for i in range(set_len):
-        first_res = None
-        if status.interrupted or generated >= set_len:
-            break
-        prompts = []
-        # Decrease batch size
-        if set_len - generated < args.sample_batch_size:
-            batch_size = set_len - generated
-        else:
-            batch_size = args.sample_batch_size
-        for b in range(batch_size):
-            # Get the new prompt data
-            pd = prompt_dataset.__getitem__(actual_idx)
-            if pd is None:
-                break
-            # Ensure that our image batches have the right resolutions
-            if first_res is None:
-                first_res = pd.resolution
-            if pd.resolution == first_res:
-                prompts.append(pd)
-                actual_idx += 1
-            else:
-                break
+    # PNGs are written in the background while the next batch generates
+    writer = ImageWriter(
+        max_pending=max(8, args.sample_batch_size * 2),
+        compress_level=args.png_compress_level
+    )
+    saved = []
 
-        new_images = builder.generate_images(prompts, pbar)
-        i_idx = 0
-        preview_images = []
-        preview_prompts = []
-        for image in new_images:
-            if generated >= set_len:
-                break
+    # Put the latents of each image straight into the training latent cache, so the dataset doesn't encode the PNG
+    # again. Only when training will read that cache: same VAE dtype, and latents encoded at exactly the bucket size.
+    latent_cache = None
+    hasher = None
+    pending_latents = []
+    train_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.mixed_precision, torch.float32)
+    if args.cache_latents and not args.latent_crop_margin and builder.latent_dtype() == train_dtype:
+        try:
+            latent_cache = LatentCache(latent_cache_dir(builder.image_pipe.vae))
+            hasher = ContentHasher(os.path.join(shared.dreambooth_cache_path, "latents", "file_hashes.json"))
+        except Exception as e:
+            print(f"Exception opening latent cache: {e}")
+            latent_cache = None
+
+    def store_latents(wait: bool = False):
+        # The cache is keyed by the hash of the PNG, so latents wait here until their file is written
+        while len(pending_latents) and (wait or pending_latents[0][0].done()):
+            future, res, latent = pending_latents.pop(0)
             try:
-                # Retrieve prompt data object
-                pd = prompts[i_idx]
-                # Save image and get new filename
-                image_filename = db_save_image(image, pd)
-                # Set filename here for later retrieval
-                pd.src_image = image_filename
-                # NOW STORE IT
-                class_prompts.append(pd)
-                if ui:
-                    out_images.append(image)
-                i_idx += 1
-                generated += 1
-                pbar.reset(set_len)
-                pbar.update(generated)
-                pbar.set_description(f"Generating class images {generated}/{set_len}:", True)
-                shared.status.job_count = set_len
-                preview_images.append(image_filename)
-                preview_prompts.append(pd.prompt)
+                latent_cache.put(latent_key(hasher.hash(future.result()), res), latent)
             except Exception as e:
-                print(f"Exception generating images: {e}")
-                traceback.print_exc()
+                print(f"Exception caching latents: {e}")
+
+    generated = 0
+    try:
+        # Every batch shares a resolution, step count and scale, and is full unless it ends its group
+        for prompts in prompt_dataset.generation_batches(args.sample_batch_size):
+            if status.interrupted or generated >= set_len:
+                break
+
+            new_latents = None
+            if latent_cache is not None:
+                new_images, new_latents = builder.generate_images(prompts, pbar, return_latents=True)
+            else:
+                new_images = builder.generate_images(prompts, pbar)
+            i_idx = 0
+            preview_images = []
+            preview_prompts = []
+            for image in new_images:
+                if generated >= set_len:
+                    break
+                try:
+                    # Retrieve prompt data object
+                    pd = prompts[i_idx]
+                    # Queue the image, its filename is set once it's written
+                    future = writer.save(image, pd, name_seed=True)
+                    saved.append((pd, future))
+                    if new_latents is not None:
+                        pending_latents.append((future, tuple(pd.resolution), new_latents[i_idx]))
+                    if ui:
+                        out_images.append(image)
+                    i_idx += 1
+                    generated += 1
+                    pbar.reset(set_len)
+                    pbar.update(generated)
+                    pbar.set_description(f"Generating class images {generated}/{set_len}:", True)
+                    shared.status.job_count = set_len
+                    preview_images.append(image)
+                    preview_prompts.append(pd.prompt)
+                except Exception as e:
+                    print(f"Exception generating images: {e}")
+                    traceback.print_exc()
 
-        status.current_image = preview_images
-        status.sample_prompts = preview_prompts
+            status.current_image = preview_images
+            status.sample_prompts = preview_prompts
+            if latent_cache is not None:
+                store_latents()
+    finally:
+        # Also on errors, so the writer threads stop and queued images still get written
+        writer.close()
+    if latent_cache is not None:
+        store_latents(wait=True)
+        try:
+            hasher.save()
+            latent_cache.flush()
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Exception saving latent cache: {e}")
+    for pd, future in saved:
+        if future.exception() is None:
+            # Set filename here for later retrieval
+            pd.src_image = future.result()
+            # NOW STORE IT
+            class_prompts.append(pd)
+            if class_cache is not None:
+                class_cache.add(class_cache.key(fingerprint, args.scheduler, pd), pd.src_image)
+    if class_cache is not None:
+        class_cache.save()
     builder.unload(ui)
     del prompt_dataset
     cleanup()
     print(f"Generated {generated} new class images.")
     if ui:
-        return generated, out_images
+        return generated + reused, out_images
     else:
-        return generated, instance_prompts, class_prompts
+        return generated + reused, instance_prompts, class_prompts
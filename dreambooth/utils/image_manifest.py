@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Tuple, Union
+
+from PIL import Image
+
+from dreambooth import shared
+
+# EXIF orientation tag, and the orientations rotate_image_straight turns by 90 degrees
+_ORIENTATION_TAG = 0x0112
+_SWAPPED_ORIENTATIONS = (6, 8)
+
+
+class ImageManifest:
+    """
+    Metadata for the images in one directory: file size and mtime, EXIF orientation, dimensions after
+    orientation and the text of the matching caption file.
+
+    Entries are refreshed one at a time when an image or its caption file changes on disk, so reading a
+    dataset's sizes and captions only has to stat its files. Manifests live in the dreambooth cache, not
+    next to the images.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        digest = hashlib.sha1(self.directory.encode()).hexdigest()[:16]
+        self.manifest_file = os.path.join(shared.dreambooth_cache_path, "manifests", f"{digest}.json")
+        # file name -> entry
+        self.entries: Dict[str, dict] = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, "r") as f:
+                    data = json.load(f)
+                if data.get("directory") == self.directory:
+                    self.entries = data.get("entries", {})
+            except Exception as e:
+                print(f"Exception loading image manifest: {e}")
+
+    def entry(self, path: str) -> dict:
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            # Only the header is read, the pixel data is never decoded
+            with Image.open(path) as img:
+                width, height = img.size
+                orientation = img.getexif().get(_ORIENTATION_TAG, 1)
+            if orientation in _SWAPPED_ORIENTATIONS:
+                width, height = height, width
+            entry = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "orientation": orientation,
+                "width": width,
+                "height": height,
+            }
+        text_file = os.path.splitext(path)[0] + ".txt"
+        try:
+            text_mtime = os.stat(text_file).st_mtime_ns
+        except OSError:
+            text_mtime = None
+        if "caption" not in entry or entry.get("caption_mtime") != text_mtime:
+            entry = dict(entry)
+            entry["caption"] = None
+            entry["caption_mtime"] = text_mtime
+            if text_mtime is not None:
+                with open(text_file, "r", encoding="utf8") as file:
+                    entry["caption"] = file.read().strip()
+        with self.lock:
+            if self.entries.get(name) is not entry:
+                self.entries[name] = entry
+                self.dirty = True
+        return entry
+
+    def dims(self, path: str) -> Tuple[int, int]:
+        """
+        Width and height of the image, after EXIF orientation is applied.
+        """
+        entry = self.entry(path)
+        return entry["width"], entry["height"]
+
+    def caption(self, path: str) -> Union[str, None]:
+        """
+        Text of the image's caption file, or None if it has none.
+        """
+        return self.entry(path)["caption"]
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                # Forget images that were removed from the directory
+                names = set(os.listdir(self.directory))
+                entries = {name: entry for name, entry in self.entries.items() if name in names}
+                os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+                tmp_file = f"{self.manifest_file}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump({"directory": self.directory, "entries": entries}, f)
+                os.replace(tmp_file, self.manifest_file)
+                self.entries = entries
+                self.dirty = False
+            except Exception as e:
+                print(f"Exception saving image manifest: {e}")
+
+
+_manifests: Dict[str, ImageManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def image_manifest(directory: str) -> ImageManifest:
+    directory = os.path.abspath(directory)
+    with _manifests_lock:
+        manifest = _manifests.get(directory)
+        if manifest is None:
+            manifest = ImageManifest(directory)
+            _manifests[directory] = manifest
+    return manifest
+
+
+def manifest_for(path: str) -> ImageManifest:
+    return image_manifest(os.path.dirname(path))
+
+
+def save_manifests():
+    with _manifests_lock:
+        manifests = list(_manifests.values())
+    for manifest in manifests:
+        manifest.save()
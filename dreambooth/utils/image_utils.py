@@ -6,6 +6,8 @@ import os
 import random
 import re
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import StringIO
 
 from diffusers.schedulers import KarrasDiffusionSchedulers
@@ -14,7 +16,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 from PIL import features, PngImagePlugin, Image, ExifTags
 
 import os
-from typing import List, Tuple, Dict, Union
+from typing import List, Tuple, Dict, Union, Set
 
 import numpy as np
 import torch
@@ -22,24 +24,24 @@ import torch.utils.checkpoint
 
 from dreambooth.dataclasses.db_concept import Concept
 from dreambooth.dataclasses.prompt_data import PromptData
+from dreambooth.utils.image_manifest import manifest_for, save_manifests
 from helpers.mytqdm import mytqdm
 from dreambooth import shared
 from dreambooth.shared import status
 
 
 def get_dim(filename, max_res):
-    with Image.open(filename) as im:
-        im = rotate_image_straight(im)
-        width, height = im.size
-        if width > max_res or height > max_res:
-            aspect_ratio = width / height
-            if width > height:
-                width = max_res
-                height = int(max_res / aspect_ratio)
-            else:
-                height = max_res
-                width = int(max_res * aspect_ratio)
-        return width, height
+    # Oriented dimensions come from the directory manifest, so the image is only opened when it changed
+    width, height = manifest_for(filename).dims(filename)
+    if width > max_res or height > max_res:
+        aspect_ratio = width / height
+        if width > height:
+            width = max_res
+            height = int(max_res / aspect_ratio)
+        else:
+            height = max_res
+            width = int(max_res * aspect_ratio)
+    return width, height
 
 
 def rotate_image_straight(image: Image) -> Image:
@@ -59,22 +61,67 @@ def rotate_image_straight(image: Image) -> Image:
     return image
 
 
-def get_images(image_path: str):
-    pil_features = list_features()
-    output = []
-    if os.path.exists(image_path):
-        for file in os.listdir(image_path):
-            # Mac creates metadata files for every image with name `._{filename}`, so we skip it
-            if sys.platform == 'darwin' and file.startswith('._'):
-                continue
-            file_path = os.path.join(image_path, file)
-            if is_image(file_path, pil_features):
-                output.append(file_path)
-            if os.path.isdir(file_path):
-                sub_images = get_images(file_path)
-                for image in sub_images:
-                    output.append(image)
-    return output
+def scan_directory(path: str, extensions: Set[str]) -> Tuple[List[str], List[str]]:
+    """
+    List the image files and subdirectories of one directory. os.scandir gets the file types from the
+    directory listing itself, so no entry needs a separate stat.
+    """
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Mac creates metadata files for every image with name `._{filename}`, so we skip it
+                if sys.platform == 'darwin' and entry.name.startswith('._'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        dirs.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as e:
+        print(f"Exception scanning {path}: {e}")
+    return files, dirs
+
+
+def get_images(image_path: str, workers: int = 8) -> List[str]:
+    """
+    Recursively list the images under image_path, sorted by path. Subdirectories are scanned level by
+    level on a thread pool, which mostly helps on network mounts where every listing is a round trip.
+    """
+    if not os.path.isdir(image_path):
+        return []
+    extensions = image_extensions()
+    output, pending = scan_directory(image_path, extensions)
+    if len(pending) and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db_scan") as pool:
+            while len(pending):
+                results = list(pool.map(lambda path: scan_directory(path, extensions), pending))
+                pending = []
+                for files, dirs in results:
+                    output.extend(files)
+                    pending.extend(dirs)
+    else:
+        while len(pending):
+            files, dirs = scan_directory(pending.pop(), extensions)
+            output.extend(files)
+            pending.extend(dirs)
+    return sorted(output)
+
+
+_image_extensions = None
+
+
+def image_extensions() -> Set[str]:
+    """
+    Image extensions PIL can open, worked out once per process.
+    """
+    global _image_extensions
+    if _image_extensions is None:
+        _image_extensions = set(list_features())
+    return _image_extensions
 
 
 def list_features():
@@ -97,7 +144,7 @@ def is_image(path: str, feats=None):
     if feats is None:
         feats = []
     if not len(feats):
-        feats = list_features()
+        feats = image_extensions()
     is_img = os.path.isfile(path) and os.path.splitext(path)[1].lower() in feats
     return is_img
 
@@ -151,6 +198,7 @@ def sort_prompts(
         prompt_list.append(pd)
         pbar.update()
         prompts[reso] = prompt_list
+    save_manifests()
     return dict(sorted(prompts.items()))
 
 
@@ -165,13 +213,10 @@ class FilenameTextGetter:
         self.shuffle_tags = shuffle_tags
 
     def read_text(self, img_path):
-        text_filename = os.path.splitext(img_path)[0] + ".txt"
         filename = os.path.basename(img_path)
 
-        if os.path.exists(text_filename):
-            with open(text_filename, "r", encoding="utf8") as file:
-                filename_text = file.read().strip()
-        else:
+        filename_text = manifest_for(img_path).caption(img_path)
+        if filename_text is None:
             filename_text = os.path.splitext(filename)[0]
             filename_text = re.sub(self.re_numbers_at_start, '', filename_text)
             if self.re_word:
@@ -439,6 +484,7 @@ def load_image_directory(db_dir, concept: Concept, is_class: bool = True) -> Lis
             is_class
         )
         captions.append(final_caption)
+    save_manifests()
 
     return list(zip(img_paths, captions))
 
@@ -472,10 +518,25 @@ def open_and_trim(image_path: str, reso: Tuple[int, int], return_pil: bool = Fal
         return np.array(image)
 
 
-def db_save_image(image: Image, prompt_data: PromptData = None, save_txt: bool = True, custom_name: str = None):
+# Class images end with the seed they were generated from, e.g. "<sha1>-s1234.png"
+_SEED_NAME = re.compile(r"-s(\d+)$")
+
+
+def seed_from_name(filename: str) -> Union[int, None]:
+    """
+    The seed stored in the name of a class image, or None if the file doesn't have one.
+    """
+    match = _SEED_NAME.search(os.path.splitext(os.path.basename(filename))[0])
+    return int(match.group(1)) if match else None
+
+
+def db_save_image(image: Image, prompt_data: PromptData = None, save_txt: bool = True, custom_name: str = None,
+                  compress_level: int = 6, name_seed: bool = False):
     image_base = hashlib.sha1(image.tobytes()).hexdigest()
 
     file_name = image_base
+    if name_seed and prompt_data is not None:
+        file_name = f"{image_base}-s{prompt_data.seed}"
     if custom_name is not None:
         file_name = custom_name
 
@@ -501,17 +562,81 @@ def db_save_image(image: Image, prompt_data: PromptData = None, save_txt: bool =
 
     image_format = Image.registered_extensions()[".png"]
 
-    image.save(image_filename, format=image_format, pnginfo=pnginfo_data)
+    image.save(image_filename, format=image_format, pnginfo=pnginfo_data, compress_level=compress_level)
 
     if save_txt and prompt_data is not None:
-        os.replace(image_filename, image_filename)
+        # The caption goes in place first, so the image never shows up without it
         txt_filename = image_filename.replace(".tmp", ".txt")
-        with open(txt_filename, "w", encoding="utf8") as file:
+        with open(f"{txt_filename}.tmp", "w", encoding="utf8") as file:
             file.write(prompt_data.prompt)
+        os.replace(f"{txt_filename}.tmp", txt_filename)
     os.replace(image_filename, image_filename.replace(".tmp", ".png"))
     return image_filename.replace(".tmp", ".png")
 
 
+class ImageWriter:
+    """
+    Saves images with db_save_image on background threads, so hashing, PNG encoding and writing overlap with
+    generating the next batch.
+
+    At most max_pending images are queued or being written, save() only blocks when that many are in flight.
+    Call flush() before anything reads the files back.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8, compress_level: int = 6):
+        self.compress_level = compress_level
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="db_image_writer")
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.lock = threading.Condition()
+        self.pending = set()
+        # Images that couldn't be written since the last flush
+        self.failed = 0
+
+    def save(self, image: Image, prompt_data: PromptData = None, save_txt: bool = True,
+             custom_name: str = None, name_seed: bool = False) -> Future:
+        """
+        Queue an image to be saved. The future resolves to the file name db_save_image returns.
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(
+                db_save_image, image, prompt_data, save_txt, custom_name, self.compress_level, name_seed
+            )
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        error = future.exception()
+        with self.lock:
+            self.pending.discard(future)
+            if error is not None:
+                self.failed += 1
+            self.lock.notify_all()
+        if error is not None:
+            print(f"Exception saving image: {error}")
+        self.slots.release()
+
+    def flush(self) -> int:
+        """
+        Wait for every queued image to be written. Returns how many failed since the last flush.
+        """
+        with self.lock:
+            # Done callbacks run after a future resolves, wait for them so every failure is counted
+            self.lock.wait_for(lambda: not self.pending)
+            failed = self.failed
+            self.failed = 0
+        return failed
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+
 def image_grid(imgs):
     rows = math.floor(math.sqrt(len(imgs)))
     while len(imgs) % rows != 0:
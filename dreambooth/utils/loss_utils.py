@@ -0,0 +1,52 @@
+from typing import NamedTuple, Union
+
+import torch
+import torch.nn.functional as F
+
+
+class LossTerms(NamedTuple):
+    # Loss to backpropagate
+    loss: torch.Tensor
+    # Mean loss of the instance and the prior samples in the batch, zero when there are none
+    instance_loss: torch.Tensor
+    prior_loss: torch.Tensor
+    # Weighted loss of every sample, shape (batch,)
+    sample_losses: torch.Tensor
+
+
+def sample_losses(model_pred: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+    """
+    Mean squared error of every sample in the batch, reduced over all but the batch dimension.
+    """
+    return F.mse_loss(model_pred.float(), target.float(), reduction="none").mean(dim=tuple(range(1, model_pred.ndim)))
+
+
+def weighted_loss(
+        losses: torch.Tensor,
+        is_prior: torch.Tensor,
+        prior_loss_weight: float,
+        split_loss: bool = True,
+        weights: Union[torch.Tensor, None] = None
+) -> LossTerms:
+    """
+    Combine per-sample losses into the training loss, using the is_prior mask on the device so nothing
+    has to be sorted or synced on the host.
+
+    With split_loss, instance and prior samples are averaged separately and the prior mean is scaled by
+    prior_loss_weight. Otherwise every prior sample is scaled by prior_loss_weight and the batch is averaged.
+    weights are extra per-sample factors, applied before either.
+    """
+    if weights is not None:
+        losses = losses * weights
+    prior_mask = is_prior.to(device=losses.device, dtype=losses.dtype)
+    instance_mask = 1.0 - prior_mask
+    num_prior = prior_mask.sum()
+    num_instance = instance_mask.sum()
+    instance_loss = (losses * instance_mask).sum() / num_instance.clamp(min=1)
+    prior_loss = (losses * prior_mask).sum() / num_prior.clamp(min=1)
+    losses = losses * (instance_mask + prior_mask * prior_loss_weight)
+    if split_loss:
+        loss = instance_loss + prior_loss_weight * prior_loss
+    else:
+        loss = losses.mean()
+    return LossTerms(loss, instance_loss, prior_loss, losses)
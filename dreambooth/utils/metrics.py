@@ -0,0 +1,242 @@
+import math
+import time
+from collections import deque
+from typing import Dict, List, Tuple, Union
+
+import torch
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class MetricsAggregator:
+    """
+    Running sums of per-step training metrics.
+
+    Tensor values are added up on the device they live on, so recording a step never waits for the GPU.
+    flush() copies every sum to the host in one transfer and returns the means since the last flush. A NaN or
+    inf loss carries into its running sum, so it's caught by the next flush without checking every step.
+    """
+
+    def __init__(self, every_steps: int = 10, every_seconds: float = 5.0):
+        self.every_steps = max(1, every_steps)
+        self.every_seconds = every_seconds
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.host_sums: Dict[str, float] = {}
+        self.steps = 0
+        # Loss summed over the whole epoch, kept apart from the per-flush sums
+        self.epoch_loss = None
+        self.last_flush = time.monotonic()
+        self.nonfinite = False
+
+    def add(self, **values: Union[torch.Tensor, float]):
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().float()
+                if name in self.sums:
+                    self.sums[name] += value
+                else:
+                    self.sums[name] = value.clone()
+            else:
+                self.host_sums[name] = self.host_sums.get(name, 0.0) + float(value)
+        loss = values.get("loss")
+        if isinstance(loss, torch.Tensor):
+            loss = loss.detach().float()
+            self.epoch_loss = loss.clone() if self.epoch_loss is None else self.epoch_loss + loss
+        self.steps += 1
+
+    def should_flush(self) -> bool:
+        if not self.steps:
+            return False
+        return self.steps >= self.every_steps or time.monotonic() - self.last_flush >= self.every_seconds
+
+    def flush(self) -> Dict[str, float]:
+        """
+        Means of every metric since the last flush, plus the epoch's loss total as epoch_loss.
+        """
+        if not self.steps:
+            return {}
+        names = list(self.sums.keys())
+        tensors = [self.sums[name] for name in names]
+        if self.epoch_loss is not None:
+            names.append("epoch_loss")
+            tensors.append(self.epoch_loss)
+        values = {}
+        if len(tensors):
+            # One host round trip for all of them
+            host = torch.stack([t.to(tensors[0].device) for t in tensors]).tolist()
+            values = dict(zip(names, host))
+        means = {name: value / self.steps for name, value in values.items() if name != "epoch_loss"}
+        for name, value in self.host_sums.items():
+            means[name] = value / self.steps
+        if "epoch_loss" in values:
+            means["epoch_loss"] = values["epoch_loss"]
+        loss = means.get("loss")
+        if loss is not None and not math.isfinite(loss):
+            self.nonfinite = True
+        self.sums = {}
+        self.host_sums = {}
+        self.steps = 0
+        self.last_flush = time.monotonic()
+        return means
+
+    def reset_epoch(self):
+        self.epoch_loss = None
+
+
+class PhaseTimer:
+    """
+    Rolling timings of the phases of a repeated job, like a training step, with the peak memory seen in each.
+
+    Phases are timed as laps: lap(name) closes the phase that started at the previous lap (or mark()) and
+    starts the next one. With use_events on a CUDA device, device phases record an event on the current stream
+    instead of waiting for the GPU, and are resolved from the events in collect(). Host phases, like waiting on
+    data, are always wall-clock time, since the GPU timeline doesn't see the host waiting.
+
+    Memory is sampled by sample_memory(), once per step rather than per phase: the device's peak allocation
+    since the last sample, and the process RSS, so it still tells something on CPU-only runs.
+    """
+
+    def __init__(self, device=None, use_events: bool = True, window: int = 200):
+        self.device = torch.device(device) if device is not None else None
+        self.use_cuda = self.device is not None and self.device.type == "cuda"
+        self.use_events = use_events and self.use_cuda
+        self.window = window
+        # name -> last `window` durations in milliseconds
+        self.times: Dict[str, deque] = {}
+        # name -> last `window` samples of peak device / cpu memory in bytes
+        self.device_memory: Dict[str, deque] = {}
+        self.cpu_memory: Dict[str, deque] = {}
+        # Phases waiting for their events to complete: (name, start event, end event)
+        self.pending: List[Tuple[str, torch.cuda.Event, torch.cuda.Event]] = []
+        self.last_time = time.perf_counter()
+        self.last_event = None
+        self.process = psutil.Process() if psutil is not None else None
+
+    def _record(self, store: Dict[str, deque], name: str, value):
+        values = store.get(name)
+        if values is None:
+            values = deque(maxlen=self.window)
+            store[name] = values
+        values.append(value)
+
+    def _event(self):
+        event = torch.cuda.Event(enable_timing=True)
+        event.record(torch.cuda.current_stream(self.device))
+        return event
+
+    def _rss(self) -> Union[int, None]:
+        if self.process is not None:
+            return self.process.memory_info().rss
+        if resource is not None:
+            # Without psutil, only the peak of the whole process is known (kilobytes on Linux)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return None
+
+    def mark(self):
+        """
+        Start a new phase without recording the time since the last lap.
+        """
+        self.last_time = time.perf_counter()
+        if self.use_events:
+            self.last_event = self._event()
+
+    def lap(self, name: str, host: bool = False):
+        """
+        Close the current phase. Host phases are timed on the host even when events are used.
+        """
+        now = time.perf_counter()
+        if self.use_events:
+            event = self._event()
+            if not host and self.last_event is not None:
+                self.pending.append((name, self.last_event, event))
+            # The next device phase starts when this one ends, host or not
+            self.last_event = event
+        if host or not self.use_events:
+            self._record(self.times, name, (now - self.last_time) * 1000)
+        self.last_time = now
+
+    def sample_memory(self, name: str = "step"):
+        """
+        Record the peak device memory since the last sample and the current RSS.
+        """
+        if self.use_cuda:
+            self._record(self.device_memory, name, torch.cuda.max_memory_allocated(self.device))
+            torch.cuda.reset_peak_memory_stats(self.device)
+        rss = self._rss()
+        if rss is not None:
+            self._record(self.cpu_memory, name, rss)
+
+    def add(self, name: str, seconds: float):
+        """
+        Record a phase measured elsewhere, like time spent loading batches on another thread.
+        """
+        self._record(self.times, name, seconds * 1000)
+
+    def collect(self):
+        """
+        Resolve the phases timed with events. Waits for the last of them to complete.
+        """
+        if not len(self.pending):
+            return
+        self.pending[-1][2].synchronize()
+        for name, start, end in self.pending:
+            self._record(self.times, name, start.elapsed_time(end))
+        self.pending = []
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Rolling median, p90, p99 and mean milliseconds of every phase, with peak device and CPU memory in MB.
+        """
+        self.collect()
+        out = {}
+        for name, values in self.times.items():
+            if not len(values):
+                continue
+            ordered = sorted(values)
+
+            def percentile(p):
+                return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+            stats = {
+                "count": len(ordered),
+                "mean_ms": sum(ordered) / len(ordered),
+                "p50_ms": percentile(50),
+                "p90_ms": percentile(90),
+                "p99_ms": percentile(99),
+            }
+            out[name] = stats
+        for name in set(self.device_memory) | set(self.cpu_memory):
+            stats = out.setdefault(name, {"count": len(self.device_memory.get(name) or self.cpu_memory[name])})
+            if name in self.device_memory:
+                stats["peak_device_mb"] = max(self.device_memory[name]) / 1024 ** 2
+            if name in self.cpu_memory:
+                stats["peak_rss_mb"] = max(self.cpu_memory[name]) / 1024 ** 2
+        return out
+
+    def log_values(self, prefix: str = "timing") -> Dict[str, float]:
+        """
+        summary() flattened for accelerator.log.
+        """
+        logs = {}
+        for name, stats in self.summary().items():
+            for key, value in stats.items():
+                if key != "count":
+                    logs[f"{prefix}/{name}_{key}"] = float(value)
+        return logs
+
+    def stats(self) -> str:
+        summary = self.summary()
+        if not len(summary):
+            return "Phase timings: none recorded."
+        return "Phase timings (p50/p90 ms): " + ", ".join(
+            f"{name} {stats['p50_ms']:.1f}/{stats['p90_ms']:.1f}" for name, stats in summary.items()
+            if "p50_ms" in stats
+        )
@@ -34,6 +34,88 @@ def encode_hidden_state(text_encoder: CLIPTextModel, input_ids, pad_tokens, b_si
     return encoder_hidden_states
 
 
+class TextEmbeddingCache:
+    """
+    Cache of text encoder outputs for once the text encoder is frozen, keyed by token IDs so identical
+    captions (e.g. class images sharing a prompt) share one entry. Entries are kept in host memory
+    and copied to the training device per batch. Once max_entries is reached, new captions are
+    still encoded, just not stored. Precomputed captions are always stored, so a fully precomputed
+    cache never needs the text encoder.
+    """
+
+    def __init__(self, pad_tokens, max_token_length, tokenizer_max_length, clip_skip, max_entries: int = 8192):
+        self.pad_tokens = pad_tokens
+        self.max_token_length = max_token_length
+        self.tokenizer_max_length = tokenizer_max_length
+        self.clip_skip = clip_skip
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        # Set once the text encoder has been moved off the training device
+        self.offloaded = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    @torch.no_grad()
+    def lookup(self, text_encoder: CLIPTextModel, input_ids: torch.Tensor, device=None,
+               keep_all: bool = False, keys: List[tuple] = None) -> List[torch.Tensor]:
+        """
+        Return the hidden state for every row of input_ids, encoding the rows that aren't cached yet.
+        keys are the rows of input_ids as tuples, pass them when input_ids are on the device so they aren't
+        read back. With keep_all, new rows are stored even past max_entries.
+        """
+        if keys is None:
+            keys = [tuple(row) for row in input_ids.tolist()]
+        missing = {}
+        for key, row in zip(keys, input_ids):
+            if key not in self.entries and key not in missing:
+                missing[key] = row
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        encoded = {}
+        if len(missing):
+            if self.offloaded and device is not None:
+                # Shouldn't happen once every caption is precomputed, but the encoder can't run on the CPU in fp16
+                print("Caption missing from the text embedding cache, moving the text encoder back to the device.")
+                text_encoder.to(device)
+                self.offloaded = False
+            encoder_device = next(text_encoder.parameters()).device
+            rows = torch.stack(list(missing.values())).to(encoder_device)
+            hidden_states = encode_hidden_state(text_encoder, rows, self.pad_tokens, len(missing),
+                                                self.max_token_length, self.tokenizer_max_length, self.clip_skip)
+            for key, hidden_state in zip(missing.keys(), hidden_states):
+                encoded[key] = hidden_state.to("cpu")
+                if keep_all or len(self.entries) < self.max_entries:
+                    self.entries[key] = encoded[key]
+        return [self.entries[key] if key in self.entries else encoded[key] for key in keys]
+
+    def precompute(self, text_encoder: CLIPTextModel, input_ids: List[torch.Tensor], batch_size: int = 64) -> bool:
+        """
+        Encode every caption ahead of training. Returns whether all of them are now cached, so the text encoder
+        can leave the device.
+        """
+        # Without pad_tokens captions keep their own lengths, so only rows of the same length are encoded together
+        by_length = {}
+        for ids in input_ids:
+            by_length.setdefault(ids.shape[-1], []).append(ids.reshape(-1, ids.shape[-1]))
+        for group in by_length.values():
+            rows = torch.cat(group, dim=0)
+            for start in range(0, len(rows), batch_size):
+                self.lookup(text_encoder, rows[start:start + batch_size], keep_all=True)
+        return all(tuple(row) in self.entries for ids in input_ids for row in ids.reshape(-1, ids.shape[-1]).tolist())
+
+    def encode(self, text_encoder: CLIPTextModel, input_ids: torch.Tensor, device, keys: List[tuple] = None
+               ) -> torch.Tensor:
+        hidden_states = torch.stack(self.lookup(text_encoder, input_ids, device, keys=keys))
+        if torch.device(device).type == "cuda":
+            # From pinned memory the copy runs asynchronously, instead of waiting for the device
+            hidden_states = hidden_states.pin_memory()
+        return hidden_states.to(device, non_blocking=True)
+
+
 def prompt_to_tags(src_prompt: str, instance_token: str = None, class_token: str = None) -> List[str]:
     src_tags = src_prompt.split(',')
     if class_token:
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+Compare the foreach EMAModel.step with the state_dict update it replaced, on a tiny UNet.
+
+    python -m helpers.ema_benchmark --device cuda --steps 200
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+from diffusers import UNet2DConditionModel
+
+from helpers.ema_model import EMAModel
+
+
+def tiny_unet() -> UNet2DConditionModel:
+    return UNet2DConditionModel(
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=2,
+        block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    )
+
+
+@torch.no_grad()
+def state_dict_step(ema: EMAModel, new_model):
+    """
+    The previous EMAModel.step: update every tensor of a fresh state_dict, then load them back into the model.
+    """
+    decay = ema.decay
+    ema_state_dict = {}
+    ema_params = ema.model.state_dict()
+    for key, param in new_model.state_dict().items():
+        ema_param = ema_params[key]
+        if "version" in key:
+            continue
+        if not torch.is_floating_point(ema_param):
+            ema_param.copy_(param)
+        else:
+            ema_param.mul_(decay)
+            ema_param.add_(param.to(dtype=ema_param.dtype), alpha=1 - decay)
+        ema_state_dict[key] = ema_param
+    ema.load(ema_state_dict)
+
+
+def time_steps(step, steps: int, device: torch.device) -> float:
+    """
+    Milliseconds per call of step, after a few warmup calls.
+    """
+    for _ in range(3):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def benchmark(device="cpu", dtype=torch.float32, steps: int = 100, update_every: int = 1):
+    device = torch.device(device)
+    unet = tiny_unet().to(device)
+    reference = EMAModel(unet, device=device, dtype=dtype)
+    ema = EMAModel(unet, device=device, dtype=dtype, update_every=update_every)
+
+    # Both paths should give the same weights when updating every step
+    with torch.no_grad():
+        for param in unet.parameters():
+            param.add_(torch.randn_like(param))
+    check = copy.deepcopy(ema)
+    check.update_every = 1
+    state_dict_step(reference, unet)
+    check.step(unet)
+    error = max(
+        (a.float() - b.float()).abs().max().item()
+        for a, b in zip(reference.model.parameters(), check.model.parameters())
+    )
+    del check
+
+    old_ms = time_steps(lambda: state_dict_step(reference, unet), steps, device)
+    new_ms = time_steps(lambda: ema.step(unet), steps, device)
+    params = sum(p.numel() for p in unet.parameters())
+    print(f"Tiny UNet: {params / 1e6:.2f}M params, {device}, EMA in {dtype}")
+    print(f"state_dict step: {old_ms:.3f} ms")
+    print(f"foreach step (update every {ema.update_every}): {new_ms:.3f} ms ({old_ms / new_ms:.1f}x)")
+    print(f"Max difference after one update: {error:.2e}")
+    return old_ms, new_ms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--update_every", type=int, default=1)
+    options = parser.parse_args()
+    benchmark(options.device, getattr(torch, options.dtype), options.steps, options.update_every)
@@ -21,6 +21,9 @@ like a regular model.
 import copy
 import os
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
 
 import safetensors.torch
 import torch
@@ -29,14 +32,17 @@ from diffusers import UNet2DConditionModel
 
 class EMAModel(object):
 
-    def __init__(self, model: UNet2DConditionModel, decay: float = 0.9999, device=None, dtype=None):
+    def __init__(self, model: UNet2DConditionModel, decay: float = 0.9999, device=None, dtype=None,
+                 update_every: int = 1):
         """
         @param model: model to initialize the EMA with
         @param decay: Decay rate to use
         @param device: If provided, copy EMA to this device (e.g. gpu), else EMA is in the same device as the model.
+        @param update_every: Only update the EMA every N steps, with the decay compounded to keep the same horizon.
         """
 
         self.decay = decay
+        self.update_every = max(1, update_every)
         self.model = copy.deepcopy(model)
         self.model.to(device, dtype=dtype)
 
@@ -44,6 +50,9 @@ class EMAModel(object):
         self.build_params()
 
         self.update_freq_counter = 0
+        # Matching EMA and model tensors, grouped for the foreach update. Rebuilt when step() gets another model.
+        self.groups = None
+        self.groups_model = None
 
     def __call__(self, *args, **kwargs):
         return self.model(*args, **kwargs)
@@ -51,67 +60,91 @@ class EMAModel(object):
     def get_model(self):
         return self.model
 
-    def build_params(self, state_dict=None):
+    @staticmethod
+    def named_tensors(model) -> dict:
         """
-        Store a copy of the EMA params in fp32.
-        If state dict is passed, the EMA params is copied from
-        the provided state dict. Otherwise, it is copied from the
-        current EMA model parameters.
+        The state_dict tensors of a model, as the live tensors and without the prefixes of DDP or torch.compile
+        wrappers.
         """
-        if state_dict is None:
-            state_dict = self.model.state_dict()
+        tensors = {}
+        for key, tensor in model.state_dict(keep_vars=True).items():
+            for prefix in ("module.", "_orig_mod."):
+                if key.startswith(prefix):
+                    key = key[len(prefix):]
+            tensors[key] = tensor
+        return tensors
 
-        # for non-float params (like registered symbols), they are copied into this dict and covered in each update
-        for param_key in state_dict:
-            if param_key in self.params:
-                self.params[param_key].copy_(state_dict[param_key])
-            else:
-                self.params[param_key] = state_dict[param_key]
+    def build_params(self, state_dict=None):
+        """
+        Index the EMA model's own tensors by name, so updates happen in place on them.
+        If state dict is passed, it is first copied into the EMA model.
+        """
+        if state_dict is not None:
+            self.model.load_state_dict(state_dict, strict=False)
+        self.params = self.named_tensors(self.model)
+        self.groups = None
 
     def load(self, state_dict, build_params=False):
         """ Load data from a state_dict """
         self.model.load_state_dict(state_dict, strict=False)
         if build_params:
-            self.build_params(state_dict)
+            self.build_params()
 
     def get_decay(self):
         return self.decay
 
-    @torch.no_grad()
-    def step(self, new_model):
-        """ One update of the EMA model based on new model weights """
-        decay = self.decay
-
-        ema_state_dict = {}
-        ema_params = self.params
-        for key, param in new_model.state_dict().items():
-            try:
-                ema_param = ema_params[key]
-            except KeyError:
-                ema_param = param.float().clone() if param.ndim == 1 else copy.deepcopy(param)
-
+    def build_groups(self, new_model):
+        """
+        Pair every EMA tensor with the model tensor it follows, and group floating point pairs by device and
+        dtype so each group is a single foreach update.
+        """
+        groups = {}
+        copies = []
+        for key, param in self.named_tensors(new_model).items():
+            ema_param = self.params.get(key)
+            if ema_param is None or "version" in key:
+                # Do not decay a model.version pytorch param
+                continue
             if param.shape != ema_param.shape:
                 raise ValueError(
                     "incompatible tensor shapes between model param and ema param"
                     + "{} vs. {}".format(param.shape, ema_param.shape)
                 )
-            if "version" in key:
-                # Do not decay a model.version pytorch param
-                continue
-
-            # for non-float params (like registered symbols), they are covered in each update
             if not torch.is_floating_point(ema_param):
+                # for non-float params (like registered symbols), they are covered in each update
                 if ema_param.dtype != param.dtype:
                     raise ValueError(
                         "incompatible tensor dtypes between model param and ema param"
                         + "{} vs. {}".format(param.dtype, ema_param.dtype)
                     )
-                ema_param.copy_(param)
-            else:
-                ema_param.mul_(decay)
-                ema_param.add_(param.to(dtype=ema_param.dtype), alpha=1 - decay)
-            ema_state_dict[key] = ema_param
-        self.load(ema_state_dict, build_params=False)
+                copies.append((ema_param, param))
+                continue
+            group = groups.setdefault((ema_param.device, ema_param.dtype, param.device, param.dtype), ([], []))
+            group[0].append(ema_param)
+            group[1].append(param)
+        self.groups = (list(groups.items()), copies)
+        self.groups_model = new_model
+
+    @torch.no_grad()
+    def step(self, new_model):
+        """ One update of the EMA model based on new model weights """
+        self.update_freq_counter += 1
+        if self.update_freq_counter % self.update_every:
+            return
+        if self.groups is None or self.groups_model is not new_model:
+            self.build_groups(new_model)
+        # Skipped steps are folded into one update with the decay they would have applied
+        decay = self.decay ** self.update_every
+
+        groups, copies = self.groups
+        for (ema_device, ema_dtype, device, dtype), (ema_params, params) in groups:
+            if ema_device != device or ema_dtype != dtype:
+                params = [param.to(device=ema_device, dtype=ema_dtype) for param in params]
+            # ema = decay * ema + (1 - decay) * param
+            torch._foreach_mul_(ema_params, decay)
+            torch._foreach_add_(ema_params, params, alpha=1 - decay)
+        for ema_param, param in copies:
+            ema_param.copy_(param)
 
     def apply(self, model):
         """
@@ -135,3 +168,165 @@ class EMAModel(object):
             unet_config_path = model_config_path.replace("ema_", "")
             if os.path.exists(unet_config_path):
                 shutil.copyfile(unet_config_path, model_config_path)
+
+
+def round_to_bf16(src: torch.Tensor, out: torch.Tensor):
+    """
+    Stochastically round fp32 src into the bf16 tensor out. Plain rounding drops the tiny per-step increments
+    of a slow EMA, stochastic rounding keeps them in expectation.
+    """
+    bits = src.view(torch.int32) + torch.randint_like(src, 0, 1 << 16, dtype=torch.int32)
+    bits.bitwise_and_(-65536)
+    out.copy_(bits.view(torch.float32))
+
+
+class OffloadedEMAModel(object):
+    """
+    EMA weights kept in host memory and updated on a background thread, so they take no device memory.
+
+    Every update_every steps, step() copies the tracked model tensors into pinned buffers with non-blocking
+    copies, and the worker thread folds that snapshot into the shadow weights once the copies are done. While
+    an update is still running, snapshots are skipped and the steps are counted, so the next update applies
+    decay ** (steps since the last one). The shadow is at most one update behind the model.
+    """
+
+    def __init__(self, tensors: Dict[str, torch.Tensor], decay: float = 0.9999, dtype=torch.float32,
+                 update_every: int = 1, select: Callable = None):
+        """
+        @param tensors: tensors to initialize the EMA with, by name
+        @param decay: Decay rate to use
+        @param dtype: dtype of the shadow weights, float32 or bfloat16
+        @param update_every: Only snapshot the model every N steps, with the decay compounded over them.
+        @param select: returns the tracked tensors of the model passed to step(), by name. Defaults to all of them.
+        """
+        self.decay = decay
+        self.dtype = dtype
+        self.update_every = max(1, update_every)
+        self.select = select or EMAModel.named_tensors
+        self.shadow = {}
+        for key, tensor in tensors.items():
+            if "version" in key or not torch.is_floating_point(tensor):
+                continue
+            self.shadow[key] = tensor.detach().to("cpu", dtype=dtype, copy=True)
+
+        self.update_freq_counter = 0
+        # Steps since the last snapshot was taken
+        self.pending_steps = 0
+        # (shadow, model tensor, pinned buffer) for every tracked tensor, bound on the first step
+        self.pairs = None
+        self.pairs_model = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db_ema")
+        self.future = None
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def get_decay(self):
+        return self.decay
+
+    def bind(self, new_model):
+        pairs = []
+        for key, param in self.select(new_model).items():
+            shadow = self.shadow.get(key)
+            if shadow is None:
+                continue
+            if param.shape != shadow.shape:
+                raise ValueError(
+                    "incompatible tensor shapes between model param and ema param"
+                    + "{} vs. {}".format(param.shape, shadow.shape)
+                )
+            buffer = torch.empty(param.shape, dtype=param.dtype, pin_memory=param.is_cuda)
+            pairs.append((shadow, param, buffer))
+        self.pairs = pairs
+        self.pairs_model = new_model
+
+    @torch.no_grad()
+    def step(self, new_model):
+        """ Snapshot the model weights for the next EMA update, unless the last one is still running """
+        self.update_freq_counter += 1
+        self.pending_steps += 1
+        if self.update_freq_counter % self.update_every:
+            return
+        if self.future is not None:
+            if not self.future.done():
+                self.skipped += 1
+                return
+            # Raises the worker's exception, if any
+            self.future.result()
+        if self.pairs is None or self.pairs_model is not new_model:
+            self.bind(new_model)
+
+        event = self.snapshot()
+        steps = self.pending_steps
+        self.pending_steps = 0
+        self.future = self.executor.submit(self.update, event, steps)
+
+    def snapshot(self):
+        """ Start copying the tracked tensors to the pinned buffers, returns the event marking their end """
+        event = None
+        for _, param, buffer in self.pairs:
+            buffer.copy_(param.detach(), non_blocking=True)
+            if param.is_cuda and event is None:
+                event = torch.cuda.Event()
+        if event is not None:
+            event.record(torch.cuda.current_stream(self.pairs[0][1].device))
+        return event
+
+    @torch.no_grad()
+    def update(self, event, steps: int):
+        if event is not None:
+            event.synchronize()
+        decay = self.decay ** steps
+        with self.lock:
+            if self.dtype == torch.float32:
+                shadows = [shadow for shadow, _, _ in self.pairs]
+                buffers = [buffer.float() for _, _, buffer in self.pairs]
+                torch._foreach_mul_(shadows, decay)
+                torch._foreach_add_(shadows, buffers, alpha=1 - decay)
+                return
+            for shadow, _, buffer in self.pairs:
+                value = shadow.float()
+                value.mul_(decay).add_(buffer.float(), alpha=1 - decay)
+                round_to_bf16(value, shadow)
+
+    def wait(self):
+        """ Wait for the running update to finish """
+        if self.future is not None:
+            self.future.result()
+
+    @torch.no_grad()
+    def sync(self):
+        """ Wait for the running update, then fold in the steps it hasn't seen, so the shadow is current """
+        self.wait()
+        if self.pending_steps and self.pairs is not None:
+            self.update(self.snapshot(), self.pending_steps)
+            self.pending_steps = 0
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        self.sync()
+        with self.lock:
+            return {key: shadow.clone() for key, shadow in self.shadow.items()}
+
+    def save_lora(self, path):
+        """ Save tracked LoRA weights in the order they were given, like save_lora_weight """
+        torch.save([shadow.float() for shadow in self.state_dict().values()], path)
+
+    def save_pretrained(self, model_path, safe_serialization=True):
+        os.makedirs(model_path, exist_ok=True)
+        model_file = os.path.join(model_path, "diffusion_pytorch_model.safetensors")
+        state_dict = self.state_dict()
+        if safe_serialization:
+            safetensors.torch.save_file(state_dict, model_file)
+        else:
+            torch.save(state_dict, model_file.replace("safetensors", "bin"))
+        model_config_path = os.path.join(model_path, "config.json")
+        if not os.path.exists(model_config_path):
+            unet_config_path = model_config_path.replace("ema_", "")
+            if os.path.exists(unet_config_path):
+                shutil.copyfile(unet_config_path, model_config_path)
+
+    def stats(self) -> str:
+        return f"EMA offload: {self.skipped} snapshots skipped while an update was running."
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -1,10 +1,10 @@
 import os
 import random
 import traceback
-from typing import List, Union
+from collections import OrderedDict
+from typing import List, Tuple, Union
 
 import torch
-from PIL import Image
 from accelerate import Accelerator
 from diffusers import DiffusionPipeline, AutoencoderKL, UNet2DConditionModel
 
@@ -40,6 +40,9 @@ class ImageBuilder:
         self.last_model = None
         self.batch_size = batch_size
         self.exception_count = 0
+        # (prompt, negative prompt) -> (prompt embeds, negative prompt embeds), least recently used first
+        self.prompt_embeds = OrderedDict()
+        self.max_prompt_embeds = 512
         use_txt2img = class_gen_method == "A1111 txt2img (Euler a)"
 
         if not image_utils.txt2img_available and use_txt2img:
@@ -167,7 +170,47 @@ class ImageBuilder:
         else:
             raise ValueError("Either `total` or `iterable` has to be defined.")
 
-    def generate_images(self, prompt_data: List[PromptData], pbar: mytqdm) -> [Image]:
+    def latent_dtype(self) -> Union[torch.dtype, None]:
+        """
+        Dtype of the latents generate_images can return, or None if this builder can't return latents.
+        """
+        if self.use_txt2img or self.image_pipe is None:
+            return None
+        return self.image_pipe.vae.dtype
+
+    def encode_prompts(self, positive_prompts: List[str], negative_prompts: List[str]) -> \
+            Union[Tuple[torch.Tensor, torch.Tensor], None]:
+        """
+        Text embeddings for a batch of prompts, assembled from embeddings cached per (prompt, negative prompt)
+        pair so each pair only goes through the text encoder once. Returns None if the pipeline can't encode
+        prompts on its own.
+        """
+        if not hasattr(self.image_pipe, "_encode_prompt"):
+            return None
+        positive_embeds = []
+        negative_embeds = []
+        for pair in zip(positive_prompts, negative_prompts):
+            embeds = self.prompt_embeds.get(pair)
+            if embeds is None:
+                # Encoded as [negative, positive] for classifier-free guidance
+                encoded = self.image_pipe._encode_prompt(pair[0], self.image_pipe.device, 1, True, pair[1])
+                negative, positive = encoded.chunk(2)
+                embeds = (positive, negative)
+                self.prompt_embeds[pair] = embeds
+                if len(self.prompt_embeds) > self.max_prompt_embeds:
+                    self.prompt_embeds.popitem(last=False)
+            else:
+                self.prompt_embeds.move_to_end(pair)
+            positive_embeds.append(embeds[0])
+            negative_embeds.append(embeds[1])
+        return torch.cat(positive_embeds), torch.cat(negative_embeds)
+
+    def generate_images(self, prompt_data: List[PromptData], pbar: mytqdm, return_latents: bool = False):
+        """
+        Generate one image per prompt. With return_latents, returns (images, latents) where latents are the
+        final denoised latents in VAE space, the same space the training latent cache stores, or None if
+        latent_dtype() is None.
+        """
         positive_prompts = []
         negative_prompts = []
         seed = -1
@@ -176,6 +219,7 @@ class ImageBuilder:
         width = self.resolution
         height = self.resolution
         output = []
+        latents = None
         for prompt in prompt_data:
             positive_prompts.append(prompt.prompt)
             negative_prompts.append(prompt.negative_prompt)
@@ -220,15 +264,34 @@ class ImageBuilder:
                     seed = int(random.randrange(0, 21474836147))
 
                 generator = torch.manual_seed(seed)
+                seeds = [prompt.seed for prompt in prompt_data]
+                if len(set(seeds)) == len(seeds) and all(isinstance(s, int) and s >= 0 for s in seeds):
+                    # Give every image its own generator, so an image only depends on its seed and not on the batch
+                    generator = [torch.Generator().manual_seed(s) for s in seeds]
+                final_latents = {}
+
+                def keep_latents(step, timestep, step_latents):
+                    # The last callback gets the latents the pipeline decodes into images
+                    final_latents["latents"] = step_latents
+
                 try:
+                    embeds = self.encode_prompts(positive_prompts, negative_prompts)
+                    if embeds is not None:
+                        prompt_args = {"prompt_embeds": embeds[0], "negative_prompt_embeds": embeds[1]}
+                    else:
+                        prompt_args = {"prompt": positive_prompts, "negative_prompt": negative_prompts}
                     output = self.image_pipe(
-                        positive_prompts,
                         num_inference_steps=steps,
                         guidance_scale=scale,
                         height=height,
                         width=width,
                         generator=generator,
-                        negative_prompt=negative_prompts).images
+                        callback=keep_latents if return_latents else None,
+                        **prompt_args).images
+                    if "latents" in final_latents:
+                        vae = self.image_pipe.vae
+                        scaling_factor = getattr(vae.config, "scaling_factor", 0.18215)
+                        latents = (final_latents["latents"] / scaling_factor).to("cpu", dtype=vae.dtype)
                     self.exception_count = 0
                 except Exception as e:
                     print(f"Exception generating images: {e}")
@@ -239,9 +302,12 @@ class ImageBuilder:
                     output = []
                     pass
 
+        if return_latents:
+            return output, latents
         return output
 
     def unload(self, is_ui):
+        self.prompt_embeds.clear()
         # If we have an image pipe, delete it
         if self.image_pipe is not None:
             del self.image_pipe
@@ -317,9 +317,12 @@ let db_titles = {
     "Apply Horizontal Flip": "Randomly decide to flip images horizontally.",
     "Batch Size": "How many images to process at once per training step?",
     "Betas": "The betas of the used by the Dadaptation schedulers. Default is 0.9, 0.999.",
+    "Cache Decoded Images": "When latents are not cached, store each image decoded and cropped to its bucket on disk, so later epochs skip decoding and resizing the original file.",
     "Cache Latents": "When this box is checked latents will be cached. Caching latents will use more VRAM, but improve training speed.",
+    "Cache Text Embeddings": "Once the text encoder is no longer being trained, reuse its output for repeated captions. Without tag shuffling, every caption is encoded up front and the text encoder is moved off the GPU.",
     "Cancel": "Cancel training.",
     "Class Batch Size": "How many classifier/regularization images to generate at once.",
+    "Class Image Cache Size (GB)": "Class images are kept in a cache shared by all models, and reused instead of generated again when the model, prompts and settings match. Least recently used images are removed above this size. 0 disables the cache.",
     "Class Images Per Instance Image": "How many classification images to use per instance image.",
     "Class Prompt": "A prompt for generating classification/regularization images. See the readme for more info.",
     "Class Token": "When using [filewords], this is the class identifier to use/find in existing prompts. Should be a single word.",
@@ -334,12 +337,17 @@ let db_titles = {
     "Create Model": "Create a new model.",
     "Create": "Create the danged model already.",
     "Custom Model Name": "A custom name to use when saving .ckpt and .pt files. Subdirectories will also be named this.",
+    "Data Loader Prefetch": "How many batches each data loader worker prepares ahead of training. Only used when Data Loader Workers is above 0.",
+    "Data Loader Workers": "Number of processes loading training batches in the background. 0 loads each batch on the training thread. Most useful when latents are not cached, so images are decoded while the GPU trains.",
     "Dataset Directory": "The directory containing training images.",
     "Debug Buckets": "Examine the instance and class images and report any instance images without corresponding class images.",
     "Decouple": "Decouple the weight decay from learning rate.",
+    "Device Prefetch Depth": "How many batches are pinned and copied to the GPU in the background while the current step trains. 0 copies each batch when it is needed.",
     "Discord Webhook": "Send training samples to a Discord channel after generation.",
     "D0": "Initial D estimate for D-adaptation",
     "Existing Prompt Contents": "If using [filewords], this tells the string builder how the existing prompts are formatted.",
+    "EMA Offload": "Keep the EMA weights in system RAM instead of VRAM, in fp32 or bf16. They are updated on a background thread from copies of the model weights, so they may lag a step behind. With LoRA, only the LoRA weights are averaged.",
+    "EMA Update Interval": "Update the EMA weights every N optimizer steps instead of every step. The decay is compounded over the skipped steps, so the average covers the same span while costing less time per step.",
     "EPS": "The epsilon value to use for the Dadaptation optimizers.",
     "Extract EMA Weights": "If EMA weights are saved in a model, these will be extracted instead of the full Unet. Probably not necessary for training or fine-tuning.",
     "Freeze CLIP Normalization Layers": "Keep the normalization layers of CLIP frozen during training. Advanced usage, may increase model performance and editability.",
@@ -363,10 +371,14 @@ let db_titles = {
     "Growth Rate": "Prevent the D estimate from growing faster than this multiplicative rate",
     "Half Model": "Enable this to generate model with fp16 precision. Results in a smaller checkpoint with minimal loss in quality.",
     "HuggingFace Token": "Your huggingface token to use for cloning files.",
+    "Image Preprocessing Workers": "Number of threads used to decode and crop images ahead of the VAE while caching latents. Set to 0 to process images on the main thread.",
     "Instance Prompt": "A prompt describing the subject. Use [Filewords] to parse image filename/.txt to insert existing prompt here.",
     "Instance Token": "When using [filewords], this is the instance identifier that is unique to your subject. Should be a single word.",
     "Learning Rate Scheduler": "The learning rate scheduler to use. All schedulers use the provided warmup time except for 'constant'.",
     "Learning Rate Warmup Steps": "Number of steps for the warmup in the lr scheduler. LR will start at 0 and increase to this value over the specified number of steps.",
+    "Latent Cache Size (GB)": "Cached latents and decoded images are shared by every model, in one store per VAE. Once a store is larger than this, the entries least recently used by any model are removed, never those of the model being trained.",
+    "Latent Crop Margin": "When caching latents, encode images this many pixels larger than their bucket so every step can use a random crop of the cached latent. With horizontal flip enabled, flipped latents are cached as well.",
+    "Latent Caching Batch Size": "How many images of the same bucket to encode with the VAE at once while caching latents. Automatically reduced if the GPU runs out of memory. The first batch is checked against encoding each image alone, and caching falls back to 1 if they don't match. Set to 1 for latents that never depend on batching.",
     "Learning Rate": "The rate at which the model learns. Default is 2e-6.",
     "Load Settings": "Load last saved training parameters for the model.",
     "Log Memory": "Log the current GPU memory usage.",
@@ -381,6 +393,8 @@ let db_titles = {
     "Max Resolution": "The resolution of input images. When using bucketing, this is the maximum size of image buckets.",
     "Max Token Length": "Maximum token length to respect. You probably want to leave this at 75.",
     "Memory Attention": "The type of memory attention to use. 'Xformers' will provide better performance than flash_attention, but requires a separate installation.",
+    "Metrics Flush Seconds": "Longest time between reading training metrics (loss, learning rate) back from the GPU, even if fewer than Metrics Flush Steps steps have run.",
+    "Metrics Flush Steps": "Training metrics are summed on the GPU and only read back every this many steps, so steps don't wait on the GPU to report the loss. Higher values log less often.",
     "Min Learning Rate": "The minimum learning rate to decrease to over time.",
     "Mixed Precision": "Use FP16 or BF16 (if available) will help improve memory performance. Required when using 'xformers'.",
     "Model Path": "The URL to the model on huggingface. Should be in the format of 'developer/model_name'.",
@@ -392,6 +406,7 @@ let db_titles = {
     "Number of Samples to Generate": "How many samples to generate per subject.",
     "Offset Noise": "Allows the model to learn brightness and contrast with greater detail during training. Value controls the strength of the effect, 0 disables it.",
     "Pad Tokens": "Pad the input images token length to this amount. You probably want to do this.",
+    "PNG Compression Level": "zlib compression level for saved class and sample images, from 0 (fastest, largest) to 9 (slowest, smallest). Images are written in the background while generation continues.",
     "Pause After N Epochs": "Number of epochs after which training will be paused for the specified time. Useful if you want to give your GPU a rest.",
     "Performance Wizard (WIP)": "Attempt to automatically set training parameters based on total VRAM. Still under development.",
     "Polynomial Power": "Power factor of the polynomial scheduler.",
@@ -429,6 +429,13 @@ def on_ui_tabs():
                                 value=1,
                                 step=1,
                             )
+                            db_class_cache_size = gr.Slider(
+                                label="Class Image Cache Size (GB)",
+                                minimum=0,
+                                maximum=100,
+                                value=10,
+                                step=1,
+                            )
                             db_gradient_set_to_none = gr.Checkbox(
                                 label="Set Gradients to None When Zeroing", value=True
                             )
@@ -504,12 +511,38 @@ def on_ui_tabs():
                             db_hflip = gr.Checkbox(
                                 label="Apply Horizontal Flip", value=False
                             )
+                            db_latent_cache_size = gr.Slider(
+                                label="Latent Cache Size (GB)",
+                                minimum=0,
+                                maximum=100,
+                                value=10,
+                                step=1,
+                            )
+                            db_latent_crop_margin = gr.Slider(
+                                label="Latent Crop Margin",
+                                value=0,
+                                minimum=0,
+                                maximum=128,
+                                step=8,
+                            )
 
                         with gr.Column():
                             gr.HTML(value="Tuning")
                             db_use_ema = gr.Checkbox(
                                 label="Use EMA", value=False
                             )
+                            db_ema_update_every = gr.Slider(
+                                label="EMA Update Interval",
+                                value=1,
+                                minimum=1,
+                                maximum=20,
+                                step=1,
+                            )
+                            db_ema_offload = gr.Dropdown(
+                                label="EMA Offload",
+                                value="none",
+                                choices=["none", "fp32", "bf16"],
+                            )
                             db_optimizer = gr.Dropdown(
                                 label="Optimizer",
                                 value="8bit AdamW",
@@ -528,6 +561,68 @@ def on_ui_tabs():
                             db_cache_latents = gr.Checkbox(
                                 label="Cache Latents", value=True
                             )
+                            db_cache_decoded_images = gr.Checkbox(
+                                label="Cache Decoded Images", value=False
+                            )
+                            db_cache_text_embeddings = gr.Checkbox(
+                                label="Cache Text Embeddings", value=True
+                            )
+                            db_cache_workers = gr.Slider(
+                                label="Image Preprocessing Workers",
+                                value=4,
+                                minimum=0,
+                                maximum=32,
+                                step=1,
+                            )
+                            db_vae_batch_size = gr.Slider(
+                                label="Latent Caching Batch Size",
+                                value=4,
+                                minimum=1,
+                                maximum=64,
+                                step=1,
+                            )
+                            db_dataloader_workers = gr.Slider(
+                                label="Data Loader Workers",
+                                value=0,
+                                minimum=0,
+                                maximum=16,
+                                step=1,
+                            )
+                            db_dataloader_prefetch = gr.Slider(
+                                label="Data Loader Prefetch",
+                                value=2,
+                                minimum=1,
+                                maximum=16,
+                                step=1,
+                            )
+                            db_device_prefetch = gr.Slider(
+                                label="Device Prefetch Depth",
+                                value=2,
+                                minimum=0,
+                                maximum=8,
+                                step=1,
+                            )
+                            db_png_compress_level = gr.Slider(
+                                label="PNG Compression Level",
+                                value=6,
+                                minimum=0,
+                                maximum=9,
+                                step=1,
+                            )
+                            db_metrics_flush_steps = gr.Slider(
+                                label="Metrics Flush Steps",
+                                value=10,
+                                minimum=1,
+                                maximum=100,
+                                step=1,
+                            )
+                            db_metrics_flush_seconds = gr.Slider(
+                                label="Metrics Flush Seconds",
+                                value=5,
+                                minimum=0.5,
+                                maximum=60,
+                                step=0.5,
+                            )
                             db_train_unet = gr.Checkbox(
                                 label="Train UNET", value=True
                             )
@@ -1192,13 +1287,22 @@ def on_ui_tabs():
         params_to_save = [
             db_model_name,
             db_attention,
+            db_cache_decoded_images,
             db_cache_latents,
+            db_cache_text_embeddings,
+            db_cache_workers,
+            db_class_cache_size,
             db_clip_skip,
             db_concepts_path,
             db_custom_model_name,
             db_noise_scheduler,
+            db_dataloader_prefetch,
+            db_dataloader_workers,
             db_deterministic,
+            db_device_prefetch,
+            db_ema_offload,
             db_ema_predict,
+            db_ema_update_every,
             db_epochs,
             db_epoch_pause_frequency,
             db_epoch_pause_time,
@@ -1210,6 +1314,8 @@ def on_ui_tabs():
             db_half_model,
             db_hflip,
             db_infer_ema,
+            db_latent_cache_size,
+            db_latent_crop_margin,
             db_learning_rate,
             db_learning_rate_min,
             db_lora_learning_rate,
@@ -1226,6 +1332,8 @@ def on_ui_tabs():
             db_lr_scheduler,
             db_lr_warmup_steps,
             db_max_token_length,
+            db_metrics_flush_seconds,
+            db_metrics_flush_steps,
             db_mixed_precision,
             db_adamw_weight_decay,
             db_model_path,
@@ -1233,6 +1341,7 @@ def on_ui_tabs():
             db_offset_noise,
             db_optimizer,
             db_pad_tokens,
+            db_png_compress_level,
             db_pretrained_vae_name_or_path,
             db_prior_loss_scale,
             db_prior_loss_target,
@@ -1274,6 +1383,7 @@ def on_ui_tabs():
             db_use_lora,
             db_use_lora_extended,
             db_use_subdir,
+            db_vae_batch_size,
             c1_class_data_dir,
             c1_class_guidance_scale,
             c1_class_infer_steps,
@@ -1400,7 +1510,8 @@ def on_ui_tabs():
         )
 
         def disable_lora(x):
-            use_ema = gr.update(interactive=not x)
+            # With LoRA, EMA follows the adapter weights in host memory
+            use_ema = gr.update(interactive=True)
             use_lora_extended = gr.update(visible=x)
             lora_save = gr.update(visible=x)
             lora_lr = gr.update(visible=x)
@@ -1540,6 +1651,7 @@ def on_ui_tabs():
                 db_stop_text_encoder,
                 db_use_lora,
                 db_use_ema,
+                db_ema_offload,
                 db_save_preview_every,
                 db_save_embedding_every,
                 db_status,